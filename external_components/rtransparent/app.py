@@ -1,26 +1,66 @@
+import asyncio
 import logging
-import tempfile
-from pathlib import Path
-
-import pandas as pd
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from typing import Optional
+
+import extraction
 import psutil
-import rpy2.robjects as ro
+import pyarrow as pa
 from fastapi import FastAPI, File, HTTPException, Query, UploadFile, status
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel
-from rpy2.robjects import pandas2ri
-from rpy2.robjects.packages import importr
-
-ro.r(f'Sys.setenv(VROOM_CONNECTION_SIZE = "{2**20}")')
 
 logger = logging.getLogger(__name__)
-app = FastAPI()
+
+# Number of worker processes, each with its own R session
+WORKERS = int(os.environ.get("RTRANSPARENT_WORKERS") or psutil.cpu_count())
+# Extraction tasks that may wait for a worker before requests are turned away
+MAX_QUEUE = int(os.environ.get("RTRANSPARENT_MAX_QUEUE") or 2 * WORKERS)
+# Seconds clients are asked to wait before retrying a rejected request
+RETRY_AFTER = 5
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+
+pool_state = {"pool": None, "ready": False, "in_flight": 0}
+
+
+async def warm_up(pool: ProcessPoolExecutor):
+    """Start every worker process so that R is loaded before the first request."""
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(
+        *(loop.run_in_executor(pool, extraction.ping) for _ in range(WORKERS))
+    )
+    pool_state["ready"] = True
+    logger.info(f"{WORKERS} R workers ready")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Spawn rather than fork so that no worker inherits an embedded R session
+    pool = ProcessPoolExecutor(
+        max_workers=WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=extraction.setup_r_environment,
+    )
+    pool_state["pool"] = pool
+    warming = asyncio.create_task(warm_up(pool))
+    yield
+    warming.cancel()
+    pool.shutdown(cancel_futures=True)
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 class HealthCheck(BaseModel):
     """Response model to validate and return when performing a health check."""
 
     status: str = "OK"
+    workers: Optional[int] = None
+    in_flight: int = 0
 
 
 @app.get(
@@ -30,95 +70,135 @@ class HealthCheck(BaseModel):
     response_description="Return HTTP Status Code 200 (OK)",
     status_code=status.HTTP_200_OK,
     response_model=HealthCheck,
+    responses={503: {"model": HealthCheck}},
 )
-def get_health() -> HealthCheck:
+def get_health():
     """
     ## Perform a Health Check
     Endpoint to perform a healthcheck on. This endpoint can primarily be used Docker
     to ensure a robust container orchestration and management is in place. Other
     services which rely on proper functioning of the API service will not deploy if this
     endpoint returns any other HTTP status code except 200 (OK).
+    Returns 503 (Service Unavailable) until the R worker processes are ready.
     Returns:
         HealthCheck: Returns a JSON response with the health status
     """
-    return HealthCheck(status="OK")
+    if not pool_state["ready"]:
+        return JSONResponse(
+            content=HealthCheck(status="STARTING").model_dump(),
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        )
+    return HealthCheck(status="OK", workers=WORKERS, in_flight=pool_state["in_flight"])
 
 
-def rtransparent_metric_extraction(
-    xml_content: bytes, parser: str, workers: int = psutil.cpu_count()
-):
-    rtransparent = importr("rtransparent")
-    future = importr("future")
-    future.plan(future.multisession, workers=workers)
-
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".xml") as temp_xml_file:
-        temp_xml_file.write(xml_content)
-        temp_xml_file_path = temp_xml_file.name
-    if parser == "PMCParser":
-        # XML files from pubmedcentral can have extra metadata exracted
-        df = extract_from_pmc_xml(temp_xml_file_path, rtransparent)
-    else:
-        df = extract_from_xml(temp_xml_file_path, rtransparent)
-    temp_xml_file.close()
-    Path(temp_xml_file_path).unlink()
-    return df
-
-
-def extract_from_xml(temp_xml_file_path, rtransparent):
-    dfs = {}
-    with (ro.default_converter + pandas2ri.converter).context():
-        dfs["data_code"] = ro.conversion.get_conversion().rpy2py(
-            rtransparent.rt_data_code(temp_xml_file_path)
+@contextmanager
+def reserve_workers(tasks: int):
+    """Admit tasks to the pool or reject the request if the queue is full."""
+    if not pool_state["ready"]:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="The R workers are starting up.",
+            headers={"Retry-After": str(RETRY_AFTER)},
+        )
+    if pool_state["in_flight"] + tasks > WORKERS + MAX_QUEUE:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many extractions are queued.",
+            headers={"Retry-After": str(RETRY_AFTER)},
         )
-    #  "all" contains fund, register, and coi outputs
-    with (ro.default_converter + pandas2ri.converter).context():
-        dfs["all"] = ro.conversion.get_conversion().rpy2py(
-            rtransparent.rt_all(temp_xml_file_path)
+    pool_state["in_flight"] += tasks
+    try:
+        yield
+    finally:
+        pool_state["in_flight"] -= tasks
+
+
+async def run_in_pool(chunks: list[list[bytes]], parser: str) -> list[dict]:
+    """Extract each chunk of documents in a worker, keeping the input order."""
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(
+        *(
+            loop.run_in_executor(
+                pool_state["pool"], extraction.extract_metrics, chunk, parser
+            )
+            for chunk in chunks
         )
-    return pd.concat([dfs["all"], dfs["data_code"].drop(columns=["article"])], axis=1)
+    )
+    return [result for chunk_results in results for result in chunk_results]
 
 
-def extract_from_pmc_xml(temp_xml_file_path, rtransparent):
-    raise NotImplementedError(
-        """
-        Not all XML files provided at pubmedcentral include the datasharing
-        statements so this is a not a priority. The data returned contains R Na
-        types which need to be converted to an appropriate python type.
-        """
-    )
-    # dfs = {}
-    # with (ro.default_converter + pandas2ri.converter).context():
-    #     dfs["meta_pmc"] = ro.conversion.get_conversion().rpy2py(
-    #         rtransparent.rt_meta_pmc(temp_xml_file_path)
-    #     )
-    # # data_code_pmc is a subset of all_pmc
-    # with (ro.default_converter + pandas2ri.converter).context():
-    #     dfs["all_pmc"] = ro.conversion.get_conversion().rpy2py(
-    #         rtransparent.rt_all_pmc(temp_xml_file_path)
-    #     )
-    # return pd.concat(
-    #     [
-    #         dfs["all_pmc"],
-    #         dfs["meta_pmc"].drop(
-    #             columns=["doi", "filename", "is_success", "pmcid_pmc", "pmid"]
-    #         ),
-    #     ],
-    #     axis=1,
-    # )
+def arrow_response(rows: list[dict]) -> Response:
+    """Return the rows as an Arrow IPC stream with missing values as nulls."""
+    # Rows for failed documents lack the metrics so collect every column
+    names = list(dict.fromkeys(name for row in rows for name in row))
+    table = pa.table({name: [row.get(name) for row in rows] for name in names})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return Response(content=sink.getvalue().to_pybytes(), media_type=ARROW_STREAM)
 
 
 @app.post("/extract-metrics/")
-async def extract_metrics(file: UploadFile = File(...), parser: str = Query("other")):
-    try:
+async def extract_metrics(
+    file: UploadFile = File(...),
+    parser: str = Query("other"),
+    format: str = Query("json", pattern="^(json|arrow)$"),
+):
+    with reserve_workers(1):
         xml_content = await file.read()
         if not xml_content:
-            raise NotImplementedError(
-                """For now the XML content must be provided. Check the output of
-                the parsing stage."""
+            raise HTTPException(
+                status_code=500,
+                detail="""For now the XML content must be provided. Check the
+                output of the parsing stage.""",
             )
-        metrics_df = rtransparent_metric_extraction(xml_content, parser)
-        logger.info(metrics_df.info())
-        return JSONResponse(content=metrics_df.iloc[0].to_dict(), status_code=200)
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        [result] = await run_in_pool([[xml_content]], parser)
+    if result["error"] is not None:
+        raise HTTPException(status_code=500, detail=result["error"])
+    if format == "arrow":
+        return arrow_response([result["metrics"]])
+    return JSONResponse(content=result["metrics"], status_code=200)
+
+
+@app.post("/extract-metrics/batch/")
+async def extract_metrics_batch(
+    files: list[UploadFile] = File(...),
+    parser: str = Query("other"),
+    format: str = Query("json", pattern="^(json|arrow)$"),
+):
+    """
+    Extract metrics for many XML files in one request. The files are split
+    between the workers and the response has one entry per file, in upload
+    order, with either the metrics or an error. With format=arrow the response
+    is an Arrow IPC stream with one row per file, holding the metrics columns
+    along with upload_filename and error columns.
+    """
+    n_chunks = min(WORKERS, len(files))
+    with reserve_workers(n_chunks):
+        xml_contents = [await file.read() for file in files]
+        results = [
+            {"filename": file.filename, "metrics": None, "error": None}
+            for file in files
+        ]
+        valid = [i for i, xml_content in enumerate(xml_contents) if xml_content]
+        for i in set(range(len(files))) - set(valid):
+            results[i]["error"] = "The XML content must be provided."
+        chunk_size = math.ceil(len(valid) / n_chunks) if valid else 1
+        chunks = [
+            [xml_contents[i] for i in valid[start : start + chunk_size]]
+            for start in range(0, len(valid), chunk_size)
+        ]
+        for i, result in zip(valid, await run_in_pool(chunks, parser)):
+            results[i].update(result)
+    if format == "arrow":
+        return arrow_response(
+            [
+                {
+                    **(result["metrics"] or {}),
+                    "upload_filename": result["filename"],
+                    "error": result["error"],
+                }
+                for result in results
+            ]
+        )
+    return JSONResponse(content=results, status_code=200)
@@ -0,0 +1,150 @@
+"""
+Metric extraction with rtransparent. This module runs inside the worker
+processes of the service, each of which embeds its own R session.
+"""
+
+import logging
+import math
+import os
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+import rpy2.robjects as ro
+from rpy2.robjects import pandas2ri
+from rpy2.robjects.packages import importr
+
+logger = logging.getLogger(__name__)
+
+# Populated once per worker process by setup_r_environment
+r_env = {}
+
+# pandas2ri represents R's NA in integer and logical vectors with this value
+R_NA_INTEGER = -2147483648
+
+# rtransparent reads its input from files, so keep them in memory backed storage
+SCRATCH_DIR = os.environ.get("RTRANSPARENT_SCRATCH_DIR") or (
+    "/dev/shm" if os.path.isdir("/dev/shm") else None
+)
+
+
+def setup_r_environment():
+    """Load the R packages once when a worker process starts."""
+    ro.r(f'Sys.setenv(VROOM_CONNECTION_SIZE = "{2**20}")')
+    r_env["rtransparent"] = importr("rtransparent")
+    # Parallelism comes from the pool of worker processes so each worker
+    # extracts its documents sequentially.
+    future = importr("future")
+    future.plan(future.sequential)
+    # Extract both indicator families for each file in a single call from
+    # python, returning the rows in the order of the paths. "all" contains
+    # fund, register, and coi outputs.
+    r_env["extract_files"] = ro.r(
+        """
+        function(paths) {
+            furrr::future_map_dfr(paths, function(path) {
+                data_code <- dplyr::select(rtransparent::rt_data_code(path), -article)
+                all <- rtransparent::rt_all(path)
+                # Columns present in both take their value from data_code
+                dplyr::bind_cols(
+                    dplyr::select(all, -dplyr::any_of(names(data_code))),
+                    data_code
+                )
+            })
+        }
+        """
+    )
+
+
+def ping() -> bool:
+    """Used to check that a worker has started and loaded R."""
+    return "rtransparent" in r_env
+
+
+def extract_metrics(xml_contents: list[bytes], parser: str) -> list[dict]:
+    """
+    Extract metrics for several documents with one call to R.
+
+    Returns one entry per document, in the order of xml_contents, holding
+    either the metrics or an error message.
+    """
+    try:
+        metrics_df = rtransparent_batch_extraction(xml_contents, parser)
+        return [
+            {"metrics": replace_na(metrics), "error": None}
+            for metrics in metrics_df.to_dict(orient="records")
+        ]
+    except Exception as e:
+        if len(xml_contents) == 1:
+            return [{"metrics": None, "error": str(e)}]
+        # Retry the documents one at a time so that a single bad document
+        # only fails its own entry
+        logger.warning(f"Batch extraction failed, extracting individually: {e}")
+        return [
+            result
+            for xml_content in xml_contents
+            for result in extract_metrics([xml_content], parser)
+        ]
+
+
+def replace_na(metrics: dict) -> dict:
+    """Replace R's missing values with None."""
+    return {
+        k: None if v == R_NA_INTEGER or (isinstance(v, float) and math.isnan(v)) else v
+        for k, v in metrics.items()
+    }
+
+
+def rtransparent_batch_extraction(
+    xml_contents: list[bytes], parser: str
+) -> pd.DataFrame:
+    """Returns one row per document in the order of xml_contents."""
+    rtransparent = r_env["rtransparent"]
+    with tempfile.TemporaryDirectory(dir=SCRATCH_DIR) as temp_dir:
+        xml_paths = []
+        for i, xml_content in enumerate(xml_contents):
+            xml_path = Path(temp_dir) / f"{i}.xml"
+            xml_path.write_bytes(xml_content)
+            xml_paths.append(str(xml_path))
+        if parser == "PMCParser":
+            # XML files from pubmedcentral can have extra metadata exracted
+            return extract_from_pmc_xml(xml_paths, rtransparent)
+        return extract_from_xml(xml_paths, rtransparent)
+
+
+def extract_from_xml(xml_paths: list[str], rtransparent):
+    with (ro.default_converter + pandas2ri.converter).context():
+        return (
+            ro.conversion.get_conversion()
+            .rpy2py(r_env["extract_files"](ro.StrVector(xml_paths)))
+            .reset_index(drop=True)
+        )
+
+
+def extract_from_pmc_xml(xml_paths, rtransparent):
+    raise NotImplementedError(
+        """
+        Not all XML files provided at pubmedcentral include the datasharing
+        statements so this is a not a priority. The data returned contains R Na
+        types which need to be converted to an appropriate python type.
+        """
+    )
+    # dfs = {}
+    # with (ro.default_converter + pandas2ri.converter).context():
+    #     dfs["meta_pmc"] = ro.conversion.get_conversion().rpy2py(
+    #         rtransparent.rt_meta_pmc(temp_xml_file_path)
+    #     )
+    # # data_code_pmc is a subset of all_pmc
+    # with (ro.default_converter + pandas2ri.converter).context():
+    #     dfs["all_pmc"] = ro.conversion.get_conversion().rpy2py(
+    #         rtransparent.rt_all_pmc(temp_xml_file_path)
+    #     )
+    # return pd.concat(
+    #     [
+    #         dfs["all_pmc"],
+    #         dfs["meta_pmc"].drop(
+    #             columns=["doi", "filename", "is_success", "pmcid_pmc", "pmid"]
+    #         ),
+    #     ],
+    #     axis=1,
+    # )
@@ -0,0 +1,172 @@
+import logging
+import threading
+import time
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# Seconds to establish a connection and to wait for a response. Converting a
+# long pdf with ScienceBeam can take minutes so the read timeout is generous.
+DEFAULT_TIMEOUT = (10, 600)
+DEFAULT_POOL_SIZE = 10
+# Busy services answer 429 or 503 with a Retry-After header, which is honoured
+RETRY_STATUSES = (429, 502, 503, 504)
+
+# Requests retried after they may have been received. PUT is left out since
+# the OSM API stores a new invocation for each PUT /upload/.
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+# The parsing and extraction services only compute a response so their POST
+# requests can be repeated
+IDEMPOTENT_SERVICE_URLS = ("http://localhost:8070/", "http://localhost:8071/")
+
+# Endpoints that respond once a service can accept work
+SERVICE_HEALTH_URLS = {
+    "sciencebeam": "http://localhost:8070/",
+    "rtransparent": "http://localhost:8071/health",
+}
+# ScienceBeam has no health endpoint, so any HTTP response from it, even a 404,
+# means it is ready. Docker accepts connections on a forwarded port before the
+# service listens behind it, but only the service can answer them.
+NO_HEALTH_ENDPOINT_SERVICES = {"sciencebeam"}
+
+_default_session: Optional[requests.Session] = None
+_default_session_lock = threading.Lock()
+_ready_services: set[str] = set()
+_readiness_locks = {name: threading.Lock() for name in SERVICE_HEALTH_URLS}
+
+
+class TimeoutSession(requests.Session):
+    """A session that applies a default timeout to every request."""
+
+    def __init__(self, timeout: tuple[float, float] = DEFAULT_TIMEOUT):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def make_session(
+    *,
+    pool_size: int = DEFAULT_POOL_SIZE,
+    timeout: tuple[float, float] = DEFAULT_TIMEOUT,
+    retries: int = 3,
+    backoff_factor: float = 0.5,
+) -> requests.Session:
+    """
+    Create a session with keep-alive connection pools, timeouts and retries.
+
+    Args:
+    - pool_size (int): Connections kept open per host.
+    - timeout (tuple[float, float]): Connect and read timeouts in seconds.
+    - retries (int): Retries for failed connections and gateway errors.
+    - backoff_factor (float): Exponential backoff between retries in seconds.
+
+    Returns:
+    - requests.Session: A session safe to share between worker threads.
+    """
+
+    def adapter(allowed_methods: frozenset[str]) -> HTTPAdapter:
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            # A read failure may mean the request was processed already
+            read=1,
+            status=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=allowed_methods,
+            # Leave the handling of error responses to the caller
+            raise_on_status=False,
+        )
+        return HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+
+    session = TimeoutSession(timeout=timeout)
+    # Uploads to the OSM API are not idempotent, a retried PUT /upload/ could
+    # store the invocation twice, so only requests that are safe to repeat
+    # are retried once they may have reached the server.
+    session.mount("http://", adapter(IDEMPOTENT_METHODS))
+    session.mount("https://", adapter(IDEMPOTENT_METHODS))
+    for prefix in IDEMPOTENT_SERVICE_URLS:
+        session.mount(prefix, adapter(IDEMPOTENT_METHODS | {"POST"}))
+    return session
+
+
+def get_session() -> requests.Session:
+    """Return the process wide session, creating it with defaults if needed."""
+    global _default_session
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = make_session()
+        return _default_session
+
+
+def set_session(session: requests.Session):
+    """Replace the process wide session, e.g. to size pools for a batch run."""
+    global _default_session
+    with _default_session_lock:
+        _default_session = session
+
+
+def wait_for_service(
+    name: str,
+    timeout: float = 300,
+    initial_delay: float = 0.25,
+    max_delay: float = 10,
+):
+    """
+    Block until a service responds, probing with exponential backoff.
+
+    Once a service has responded it is assumed to stay ready for the rest of
+    the process, so only the first caller pays for the probing. A service is
+    ready when its health endpoint answers with a 2xx status, or for those in
+    NO_HEALTH_ENDPOINT_SERVICES when it answers at all without a server error.
+
+    Args:
+    - name (str): A key of SERVICE_HEALTH_URLS.
+    - timeout (float): Seconds to wait before raising TimeoutError.
+    - initial_delay (float): Seconds to wait after the first failed probe.
+    - max_delay (float): Upper bound on the wait between probes.
+    """
+    if name in _ready_services:
+        return
+    with _readiness_locks[name]:
+        deadline = time.monotonic() + timeout
+        delay = initial_delay
+        while not probe_service(name):
+            if time.monotonic() + delay > deadline:
+                raise TimeoutError(
+                    f"{name} was not ready after {timeout}s ({SERVICE_HEALTH_URLS[name]})"
+                )
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+
+def probe_service(name: str) -> bool:
+    """Check once whether a service is ready, remembering a positive answer."""
+    if name in _ready_services:
+        return True
+    # Probes should fail fast rather than go through the retrying adapters
+    with make_session(pool_size=1, timeout=(2, 5), retries=0) as probe:
+        try:
+            status = probe.get(SERVICE_HEALTH_URLS[name]).status_code
+        except requests.exceptions.RequestException:
+            status = None
+    if status is None:
+        ready = False
+    elif name in NO_HEALTH_ENDPOINT_SERVICES:
+        ready = status < 500
+    else:
+        # A 404 means the url is wrong rather than the service ready
+        ready = 200 <= status < 300
+    if ready:
+        _ready_services.add(name)
+        logger.info(f"{name} is ready")
+    return ready
@@ -0,0 +1,153 @@
+"""
+Keep the docker compose services running between osm invocations.
+
+Each invocation that reuses the services holds a lease, a file named after its
+process id. When an invocation finishes it starts a reaper process (unless one
+is already running) that stops the services once no lease has been held for the
+idle timeout.
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from osm._utils import _get_cache_dir, compose_down
+
+logger = logging.getLogger(__name__)
+
+
+def _get_lease_dir() -> Path:
+    # The compose project is defined by the working directory
+    project = hashlib.sha256(str(Path.cwd().resolve()).encode()).hexdigest()[:12]
+    lease_dir = _get_cache_dir() / "leases" / project
+    lease_dir.mkdir(parents=True, exist_ok=True)
+    return lease_dir
+
+
+@contextmanager
+def _locked(lease_dir: Path):
+    """Serialize taking leases with the reaper stopping the services."""
+    try:
+        # Imported here so that osm still starts where fcntl is unavailable
+        import fcntl
+    except ImportError:
+        logger.warning("File locking is not available, leases are not serialized")
+        yield
+        return
+    with (lease_dir / ".lock").open("w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def active_leases(lease_dir: Path) -> list[int]:
+    """Return the process ids holding a lease, dropping those of dead processes."""
+    pids = []
+    for lease in lease_dir.glob("*.lease"):
+        pid = int(lease.stem)
+        if _is_running(pid):
+            pids.append(pid)
+        else:
+            lease.unlink(missing_ok=True)
+    return pids
+
+
+class ServiceLease:
+    """Mark the services as in use by this process."""
+
+    def __init__(self):
+        self.lease_dir = _get_lease_dir()
+        self.path = self.lease_dir / f"{os.getpid()}.lease"
+
+    def acquire(self):
+        with _locked(self.lease_dir):
+            self.path.touch()
+
+    def release(self):
+        with _locked(self.lease_dir):
+            self.path.unlink(missing_ok=True)
+            (self.lease_dir / "last_used").touch()
+
+
+def stop_services():
+    """Stop the services unless a run that reuses them holds a lease."""
+    lease_dir = _get_lease_dir()
+    with _locked(lease_dir):
+        if leases := active_leases(lease_dir):
+            print(f"Containers are left running for the processes {leases}")
+            return
+        compose_down()
+
+
+def start_reaper(idle_timeout: float):
+    """Start a background process to stop the services once they are idle."""
+    lease_dir = _get_lease_dir()
+    pid_file = lease_dir / "reaper.pid"
+    with _locked(lease_dir):
+        if pid_file.exists() and _is_running(int(pid_file.read_text())):
+            return
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "osm._services",
+                "--idle-timeout",
+                str(idle_timeout),
+            ],
+            cwd=Path.cwd(),
+            start_new_session=True,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        pid_file.write_text(str(process.pid))
+    print(f"Containers are left running and stop after {idle_timeout} idle minutes")
+
+
+def reap(idle_timeout: float):
+    """Stop the services once they have not been leased for idle_timeout minutes."""
+    lease_dir = _get_lease_dir()
+    last_used = lease_dir / "last_used"
+    idle_seconds = idle_timeout * 60
+    while True:
+        time.sleep(min(idle_seconds, 60))
+        with _locked(lease_dir):
+            if active_leases(lease_dir):
+                continue
+            if last_used.exists() and (
+                time.time() - last_used.stat().st_mtime < idle_seconds
+            ):
+                continue
+            compose_down()
+            (lease_dir / "reaper.pid").unlink(missing_ok=True)
+            return
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Stop the osm containers once they are idle."
+    )
+    parser.add_argument("--idle-timeout", type=float, required=True)
+    reap(parser.parse_args().idle_timeout)
+
+
+if __name__ == "__main__":
+    main()
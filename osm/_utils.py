@@ -1,16 +1,21 @@
 import argparse
+import csv
 import datetime
+import glob
+import json
 import logging
 import os
 import re
-import time
 import types
+from collections import Counter
 from pathlib import Path
 
 import pandas as pd
-import requests
+
+from osm._http import SERVICE_HEALTH_URLS, probe_service, wait_for_service
 
 DEFAULT_OUTPUT_DIR = "./osm_output"
+SUPPORTED_SUFFIXES = (".pdf", ".xml")
 logger = logging.getLogger(__name__)
 
 ERROR_CSV_PATH = Path("error_log.csv")
@@ -53,6 +58,14 @@ def _get_logs_dir(output_dir: Path = DEFAULT_OUTPUT_DIR) -> Path:
     return logs_dir
 
 
+def _get_cache_dir() -> Path:
+    """Cache shared by all runs so reprocessing can reuse earlier results."""
+    cache_home = os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")
+    cache_dir = Path(cache_home) / "osm"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
 def _existing_file(path_string):
     path = Path(path_string)
     if not path.exists():
@@ -69,26 +82,89 @@ def wait_for_containers():
     A hack for now, on Apple Silicon, the parser container fails. Ideally we
     would just use the wait kwargs for docker compose up
     """
-    while True:
-        try:
-            response = requests.get("http://localhost:8071/health")
-            if response.status_code == 200:
-                break
-        except requests.exceptions.RequestException:
-            pass
+    wait_for_service("rtransparent")
+
 
-        time.sleep(1)
+def _load_image_state(state_path: Path) -> dict:
+    try:
+        return json.loads(state_path.read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
 
 
-def compose_up():
+def _refresh_images(docker, image_ttl: datetime.timedelta):
+    """
+    Pull the compose images that are missing or were last checked more than
+    image_ttl ago, and record their resolved ids and digests.
+
+    If the registry cannot be reached the local images are used so that
+    offline runs can still start.
+    """
+    state_path = _get_cache_dir() / "images.json"
+    state = _load_image_state(state_path)
+    now = datetime.datetime.now(datetime.UTC)
+    images = {
+        service.image
+        for service in docker.compose.config().services.values()
+        if service.image
+    }
+
+    def is_stale(image: str) -> bool:
+        if not docker.image.exists(image) or image not in state:
+            return True
+        checked_at = datetime.datetime.fromisoformat(state[image]["checked_at"])
+        return now - checked_at > image_ttl
+
+    stale = [image for image in sorted(images) if is_stale(image)]
+    if not stale:
+        return
+    # Pulled one at a time so that an image that fails does not prevent
+    # recording the others
+    for image in stale:
+        try:
+            docker.image.pull(image, quiet=True)
+        except Exception as e:
+            logger.warning(f"Could not pull {image}, using the local image: {e}")
+            continue
+        inspected = docker.image.inspect(image)
+        state[image] = {
+            "id": inspected.id,
+            "repo_digests": inspected.repo_digests,
+            "checked_at": now.isoformat(),
+        }
+        state_path.write_text(json.dumps(state, indent=2))
+
+
+def compose_up(pull: str = "auto", image_ttl: float = 24):
+    """
+    Start the docker compose services.
+
+    Args:
+    - pull (str): "always", "missing" or "never" are passed to docker compose.
+      "auto" only pulls images that are missing or older than image_ttl.
+    - image_ttl (float): Hours after which "auto" checks for newer images.
+    """
     from python_on_whales import docker
 
     logger.info("Waiting for containers to be ready...")
     print("Waiting for containers to be ready...")
-    docker.compose.up(detach=True, wait=True, pull="always")
+    if pull == "auto":
+        _refresh_images(docker, datetime.timedelta(hours=image_ttl))
+        pull = "missing"
+    docker.compose.up(detach=True, wait=True, pull=pull)
     print("Containers ready!")
 
 
+def _start_services(args):
+    """Start the containers unless a warm run can reuse healthy ones."""
+    if args.idle_timeout is not None and all(
+        probe_service(name) for name in SERVICE_HEALTH_URLS
+    ):
+        print("Reusing running containers")
+        return
+    compose_up(pull=args.pull, image_ttl=args.image_ttl)
+
+
 def compose_down():
     from python_on_whales import docker
 
@@ -147,10 +223,84 @@ def _setup(args):
     # create logs directory if necessary
     _ = _get_logs_dir()
     if not args.user_managed_compose:
-        compose_up()
+        _start_services(args)
     return xml_path, metrics_path
 
 
+def _discover_documents(batch: str) -> list[tuple[Path, str]]:
+    """
+    Resolve the batch input to a list of (filepath, uid) pairs.
+
+    Args:
+    - batch (str): A directory (searched recursively), a glob pattern, or a
+      manifest. A manifest is a csv file with "filepath" and "uid" columns or a
+      text file with one path per line. Unless given by the manifest, the uid
+      is the file name without its suffix.
+
+    Returns:
+    - list[tuple[Path, str]]: The documents to process.
+    """
+    path = Path(batch)
+    if path.is_dir():
+        paths = sorted(
+            p for p in path.rglob("*") if p.suffix.lower() in SUPPORTED_SUFFIXES
+        )
+        documents = [(p, p.stem) for p in paths]
+    elif path.is_file() and path.suffix.lower() == ".csv":
+        with path.open(newline="") as manifest:
+            documents = [
+                (Path(row["filepath"]), row.get("uid") or Path(row["filepath"]).stem)
+                for row in csv.DictReader(manifest)
+            ]
+    elif path.is_file():
+        lines = [line.strip() for line in path.read_text().splitlines()]
+        documents = [(Path(line), Path(line).stem) for line in lines if line]
+    else:
+        paths = sorted(
+            Path(p)
+            for p in glob.glob(batch, recursive=True)
+            if Path(p).suffix.lower() in SUPPORTED_SUFFIXES
+        )
+        documents = [(p, p.stem) for p in paths]
+
+    if not documents:
+        raise ValueError(f"No pdf or xml files found for {batch}")
+    missing = [str(p) for p, _ in documents if not p.exists()]
+    if missing:
+        raise FileNotFoundError(f"Files listed for processing do not exist: {missing}")
+    uid_counts = Counter(make_uid_path_safe(uid) for _, uid in documents)
+    duplicates = {uid for uid, count in uid_counts.items() if count > 1}
+    if duplicates:
+        raise ValueError(
+            f"Unique ids must be unique within a batch, provide a manifest: {duplicates}"
+        )
+    return documents
+
+
+def _setup_batch(args) -> list[tuple[Path, str, Path, Path]]:
+    """
+    Prepare the output directories for a batch run and start the containers
+    once for all of the documents. Documents that already have metrics are
+    skipped so that an interrupted batch can be rerun.
+    """
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    text_dir = _get_text_dir(output_dir)
+    metrics_dir = _get_metrics_dir(output_dir)
+    _ = _get_logs_dir(output_dir)
+    documents = []
+    for filepath, uid in _discover_documents(args.batch):
+        safe_uid = make_uid_path_safe(uid)
+        metrics_path = metrics_dir / f"{safe_uid}.json"
+        if metrics_path.exists():
+            logger.info(f"Skipping {filepath}, metrics exist at {metrics_path}")
+            continue
+        documents.append((filepath, uid, text_dir / f"{safe_uid}.xml", metrics_path))
+    if not args.user_managed_compose:
+        _start_services(args)
+    return documents
+
+
 def coerce_to_string(v):
     "Can be useful for schemas with permissive string fields"
     if isinstance(v, (int, float, bool)):
@@ -1,10 +1,32 @@
 import argparse
+from pathlib import Path
+from typing import Optional
 
-from osm._utils import DEFAULT_OUTPUT_DIR, _existing_file, _setup, compose_down
+import requests
+
+from osm._http import DEFAULT_TIMEOUT, make_session, set_session
+from osm._services import ServiceLease, start_reaper, stop_services
+from osm._utils import (
+    DEFAULT_OUTPUT_DIR,
+    _existing_file,
+    _get_cache_dir,
+    _setup,
+    _setup_batch,
+)
+from osm.pipeline.batch import BatchPipeline, Document
+from osm.pipeline.cache import MetricsCache, ParsedCache
 from osm.pipeline.core import Pipeline, Savers
 from osm.pipeline.extractors import RTransparentExtractor
+from osm.pipeline.outbox import Outbox
 from osm.pipeline.parsers import NoopParser, PMCParser, ScienceBeamParser
-from osm.pipeline.savers import FileSaver, JSONSaver, OSMSaver
+from osm.pipeline.savers import (
+    MAX_BATCH_BYTES,
+    FileSaver,
+    JSONSaver,
+    OSMSaver,
+    ParquetSaver,
+    UploadBuffer,
+)
 
 PARSERS = {
     "sciencebeam": ScienceBeamParser,
@@ -19,18 +41,24 @@ EXTRACTORS = {
 def parse_args():
     parser = argparse.ArgumentParser(description=("""Manage the execution of osm."""))
 
-    parser.add_argument(
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument(
         "-f",
         "--filepath",
         type=_existing_file,
-        required=True,
         help="Specify the path to the pdf/xml for processing.",
     )
+    inputs.add_argument(
+        "-b",
+        "--batch",
+        help="""Process many pdf/xml files in one run. Provide a directory, a
+        glob pattern, or a manifest (a csv with filepath and uid columns, or a
+        text file with one path per line). The uid defaults to the file name.""",
+    )
     parser.add_argument(
         "-u",
         "--uid",
-        required=True,
-        help="Specify a unique id for the work. This can be a DOI, PMID, OpenAlex ID, or Scopus ID.",
+        help="Specify a unique id for the work. This can be a DOI, PMID, OpenAlex ID, or Scopus ID. Required with --filepath.",
     )
     parser.add_argument(
         "--output_dir",
@@ -51,6 +79,14 @@ def parse_args():
         nargs="+",
         help="Select the tool for extracting the output metrics. Default is 'rtransparent'.",
     )
+    parser.add_argument(
+        "--rtransparent-format",
+        choices=["json", "arrow"],
+        default="json",
+        help="""Format of the metrics returned by rtransparent. 'arrow' returns
+        typed values with missing values as nulls and needs an rtransparent
+        image that supports it. Default is 'json'.""",
+    )
     parser.add_argument(
         "--comment",
         required=False,
@@ -68,35 +104,248 @@ def parse_args():
         help="""Disable starting and stopping the docker compose managed containers.
         Can be useful for debugging and repeatedly running the processing.""",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        metavar="MINUTES",
+        help="""Leave the containers running after processing so that later runs
+        can reuse them. They are stopped once no run has used them for MINUTES.""",
+    )
+    parser.add_argument(
+        "--pull",
+        choices=["auto", "always", "missing", "never"],
+        default="auto",
+        help="""When to pull the docker images. The default, 'auto', only pulls
+        images that are missing or have not been checked for --image-ttl hours.""",
+    )
+    parser.add_argument(
+        "--image-ttl",
+        type=float,
+        default=24,
+        help="Hours before 'auto' checks the registry for newer images. Default is 24.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="""Number of worker threads for each of the parsing, extraction and
+        saving stages with --batch. Default is 4.""",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        help="""Directory for cached parser and extractor output, reused across
+        runs. Default is $XDG_CACHE_HOME/osm or ~/.cache/osm.""",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always rerun the parsers and extractors instead of reusing cached output.",
+    )
+    parser.add_argument(
+        "--metrics-cache-size",
+        type=int,
+        default=1024,
+        help="Size in MB above which the oldest cached extractor output is evicted.",
+    )
+    parser.add_argument(
+        "--http-timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT[1],
+        help=f"""Seconds to wait for a response from the parsing, extraction and
+        upload services before giving up. Default is {DEFAULT_TIMEOUT[1]}.""",
+    )
+    parser.add_argument(
+        "--parquet-dir",
+        type=Path,
+        help="""Also append the metrics to a Parquet dataset in this directory
+        for analysis.""",
+    )
+    parser.add_argument(
+        "--partition-by",
+        nargs="*",
+        default=["year"],
+        help="Columns used to partition the --parquet-dir dataset. Default is 'year'.",
+    )
+    parser.add_argument(
+        "--upload-batch-size",
+        type=int,
+        help="""Number of invocations sent to the OSM API with each request.
+        Larger batches suit --batch runs. Default is 1, or 100 with --outbox.""",
+    )
+    parser.add_argument(
+        "--upload-max-wait",
+        type=float,
+        default=30,
+        help="Seconds before a partial batch of invocations is uploaded. Default is 30.",
+    )
+    parser.add_argument(
+        "--upload-max-mb",
+        type=float,
+        default=MAX_BATCH_BYTES / 2**20,
+        help=f"""Size in MB of the JSON uploaded with each request, which holds
+        the input documents. Default is {MAX_BATCH_BYTES // 2**20}.""",
+    )
+    parser.add_argument(
+        "--outbox",
+        action="store_true",
+        help="""Queue the invocations in a durable outbox in the cache directory
+        and upload them in the background, so that processing continues while
+        the OSM API is slow or unavailable. Invocations that are not uploaded
+        by the end of the run are uploaded by a later run.""",
+    )
+    parser.add_argument(
+        "--outbox-drain-timeout",
+        type=float,
+        default=60,
+        help="Seconds to wait for the outbox to be uploaded at the end of a run. Default is 60.",
+    )
+    args = parser.parse_args()
+    if args.filepath and not args.uid:
+        parser.error("--uid is required when processing a single --filepath")
+    return args
+
+
+def build_caches(args) -> tuple[Optional[ParsedCache], Optional[MetricsCache]]:
+    if args.no_cache:
+        return None, None
+    cache_dir = args.cache_dir or _get_cache_dir()
+    return (
+        ParsedCache(cache_dir),
+        MetricsCache(cache_dir, max_bytes=args.metrics_cache_size * 2**20),
+    )
+
+
+def build_pipeline(
+    args,
+    document: Document,
+    parsed_cache: Optional[ParsedCache] = None,
+    metrics_cache: Optional[MetricsCache] = None,
+    session: Optional[requests.Session] = None,
+    parquet_saver: Optional[ParquetSaver] = None,
+    upload_buffer: Optional[UploadBuffer | Outbox] = None,
+) -> Pipeline:
+    # xml input needs no pdf to text conversion
+    parsers = ["no-op"] if document.input_path.suffix == ".xml" else args.parser
+    return Pipeline(
+        input_path=document.input_path,
+        xml_path=document.xml_path,
+        metrics_path=document.metrics_path,
+        parsed_cache=parsed_cache,
+        metrics_cache=metrics_cache,
+        uid=document.uid,
+        parsers=[PARSERS[p](session=session) for p in parsers],
+        extractors=[
+            EXTRACTORS[m](session=session, response_format=args.rtransparent_format)
+            for m in args.metrics_type
+        ],
+        savers=Savers(
+            file_saver=FileSaver(),
+            json_saver=JSONSaver(),
+            osm_saver=OSMSaver(
+                comment=args.comment,
+                email=args.email,
+                user_defined_id=document.uid,
+                filename=document.input_path.name,
+                session=session,
+                upload_buffer=upload_buffer,
+            ),
+            parquet_saver=parquet_saver,
+        ),
+    )
+
+
+def close_savers(
+    args,
+    parquet_saver: Optional[ParquetSaver] = None,
+    upload_buffer: Optional[UploadBuffer | Outbox] = None,
+):
+    """Write out the metrics and invocations still buffered at the end of a run."""
+    if parquet_saver is not None:
+        parquet_saver.close()
+    if isinstance(upload_buffer, Outbox):
+        upload_buffer.close(timeout=args.outbox_drain_timeout)
+    elif upload_buffer is not None:
+        upload_buffer.close()
 
 
 def main():
     args = parse_args()
+    parsed_cache, metrics_cache = build_caches(args)
+    # Each worker thread of every stage may hold a connection to a service
+    session = make_session(
+        pool_size=args.workers, timeout=(DEFAULT_TIMEOUT[0], args.http_timeout)
+    )
+    set_session(session)
+    parquet_saver = None
+    if args.parquet_dir is not None:
+        parquet_saver = ParquetSaver(args.parquet_dir, partition_cols=args.partition_by)
+    upload_buffer = None
+    if args.outbox:
+        upload_buffer = Outbox(
+            (args.cache_dir or _get_cache_dir()) / "outbox.sqlite",
+            batch_size=args.upload_batch_size or 100,
+            max_wait=args.upload_max_wait,
+            session=session,
+            max_batch_bytes=int(args.upload_max_mb * 2**20),
+        )
+    elif args.upload_batch_size and args.upload_batch_size > 1:
+        upload_buffer = UploadBuffer(
+            batch_size=args.upload_batch_size,
+            max_wait=args.upload_max_wait,
+            session=session,
+            max_batch_bytes=int(args.upload_max_mb * 2**20),
+        )
+    lease = None
+    if args.idle_timeout is not None and not args.user_managed_compose:
+        lease = ServiceLease()
+        lease.acquire()
     try:
-        xml_path, metrics_path = _setup(args)
-
-        pipeline = Pipeline(
-            input_path=args.filepath,
-            xml_path=xml_path,
-            metrics_path=metrics_path,
-            parsers=[PARSERS[p]() for p in args.parser],
-            extractors=[EXTRACTORS[m]() for m in args.metrics_type],
-            savers=Savers(
-                file_saver=FileSaver(),
-                json_saver=JSONSaver(),
-                osm_saver=OSMSaver(
-                    comment=args.comment,
-                    email=args.email,
-                    user_defined_id=args.uid,
-                    filename=args.filepath.name,
+        if args.batch:
+            documents = [Document(*paths) for paths in _setup_batch(args)]
+            batch = BatchPipeline(
+                documents=documents,
+                pipeline_factory=lambda document: build_pipeline(
+                    args,
+                    document,
+                    parsed_cache,
+                    metrics_cache,
+                    session,
+                    parquet_saver,
+                    upload_buffer,
                 ),
-            ),
-        )
-        pipeline.run(user_managed_compose=args.user_managed_compose)
+                workers=args.workers,
+            )
+            summary = batch.run(user_managed_compose=args.user_managed_compose)
+            if summary.failed:
+                # A non-zero exit status lets schedulers notice failed documents
+                raise SystemExit(
+                    f"{len(summary.failed)} of {len(documents)} documents failed: "
+                    + ", ".join(
+                        str(document.input_path) for document, _ in summary.failed
+                    )
+                )
+        else:
+            xml_path, metrics_path = _setup(args)
+            document = Document(args.filepath, args.uid, xml_path, metrics_path)
+            pipeline = build_pipeline(
+                args,
+                document,
+                parsed_cache,
+                metrics_cache,
+                parquet_saver=parquet_saver,
+                upload_buffer=upload_buffer,
+            )
+            pipeline.run(user_managed_compose=args.user_managed_compose)
     finally:
-        if not args.user_managed_compose:
-            compose_down()
+        try:
+            close_savers(args, parquet_saver, upload_buffer)
+        finally:
+            if lease is not None:
+                lease.release()
+                start_reaper(args.idle_timeout)
+            elif not args.user_managed_compose:
+                stop_services()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,175 @@
+import logging
+import queue
+import threading
+import time
+from collections.abc import Callable, Iterable
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Optional
+
+from .core import Pipeline
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the input for a stage worker
+_DONE = object()
+
+
+@dataclass
+class Document:
+    """A single input file and the locations its outputs are written to."""
+
+    input_path: Path
+    uid: str
+    xml_path: Path
+    metrics_path: Path
+
+
+@dataclass
+class BatchSummary:
+    processed: int = 0
+    failed: list[tuple[Document, Exception]] = field(default_factory=list)
+    elapsed: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """Documents per second, failures included."""
+        total = self.processed + len(self.failed)
+        return total / self.elapsed if self.elapsed else 0.0
+
+
+@dataclass
+class Stage:
+    """A step of the batch run executed by its own pool of worker threads."""
+
+    name: str
+    func: Callable[[Any], Any]
+    workers: int = 1
+
+
+class StagedExecutor:
+    """Run items through a sequence of stages linked by bounded queues.
+
+    Items are usually Documents but anything can be passed through the stages.
+
+    Every stage has its own worker threads so that, for example, parsing of one
+    document overlaps with extraction of the previous one and the upload of the
+    one before that. The queues between stages hold at most `queue_size` items,
+    so a slow stage blocks the stages feeding it instead of letting finished
+    work pile up in memory.
+    """
+
+    def __init__(self, stages: list[Stage], queue_size: int = 4):
+        self.stages = stages
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+
+    def _work(
+        self,
+        stage: Stage,
+        inbox: queue.Queue,
+        outbox: Optional[queue.Queue],
+        summary: BatchSummary,
+    ):
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                return
+            document, value = item
+            try:
+                result = stage.func(value)
+            except Exception as e:
+                name = getattr(document, "input_path", document)
+                logger.error(f"{stage.name} failed for {name}: {e}")
+                with self._lock:
+                    summary.failed.append((document, e))
+                continue
+            if outbox is None:
+                with self._lock:
+                    summary.processed += 1
+            else:
+                outbox.put((document, result))
+
+    def run(self, documents: Iterable[Document]) -> BatchSummary:
+        summary = BatchSummary()
+        inboxes = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        outboxes = [*inboxes[1:], None]
+        pools = [
+            [
+                threading.Thread(
+                    target=self._work,
+                    args=(stage, inbox, outbox, summary),
+                    name=f"osm-{stage.name}-{i}",
+                    daemon=True,
+                )
+                for i in range(stage.workers)
+            ]
+            for stage, inbox, outbox in zip(self.stages, inboxes, outboxes)
+        ]
+        for thread in (thread for pool in pools for thread in pool):
+            thread.start()
+
+        # Blocks whenever the first stage falls behind
+        for document in documents:
+            inboxes[0].put((document, document))
+        # Once a stage has drained its input its outputs are all queued for the
+        # next stage, which can then be told to finish too.
+        for inbox, pool in zip(inboxes, pools):
+            for _ in pool:
+                inbox.put(_DONE)
+            for thread in pool:
+                thread.join()
+        return summary
+
+
+class BatchPipeline:
+    """Run many documents through a pipeline with overlapped stages.
+
+    Each document gets a fresh Pipeline from `pipeline_factory` because
+    components keep per-document state (e.g. `sample`). Parsing, extraction and
+    saving each get `workers` threads. The containers are expected to be up for
+    the whole run; starting and stopping them is left to the caller.
+    """
+
+    def __init__(
+        self,
+        *,
+        documents: Iterable[Document],
+        pipeline_factory: Callable[[Document], Pipeline],
+        workers: int = 4,
+        queue_size: Optional[int] = None,
+    ):
+        self.documents = documents
+        self.pipeline_factory = pipeline_factory
+        self.workers = workers
+        self.queue_size = queue_size or workers
+
+    def run(self, user_managed_compose: bool = False) -> BatchSummary:
+        def parse(document: Document) -> tuple[Pipeline, list]:
+            pipeline = self.pipeline_factory(document)
+            return pipeline, pipeline.parse(user_managed_compose=user_managed_compose)
+
+        def extract(parsed: tuple[Pipeline, list]) -> tuple[Pipeline, list[dict]]:
+            pipeline, parsed_data = parsed
+            return pipeline, pipeline.extract(parsed_data)
+
+        def save(extracted: tuple[Pipeline, list[dict]]):
+            pipeline, metrics = extracted
+            pipeline.save(metrics)
+
+        executor = StagedExecutor(
+            [
+                Stage("parse", parse, self.workers),
+                Stage("extract", extract, self.workers),
+                Stage("save", save, self.workers),
+            ],
+            queue_size=self.queue_size,
+        )
+        start = time.monotonic()
+        summary = executor.run(self.documents)
+        summary.elapsed = time.monotonic() - start
+        print(
+            f"Processed {summary.processed} documents ({len(summary.failed)} failed) "
+            f"in {summary.elapsed:.1f}s ({summary.throughput:.2f} documents/s)"
+        )
+        return summary
@@ -0,0 +1,134 @@
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from osm._utils import make_uid_path_safe
+
+from .core import Component
+
+logger = logging.getLogger(__name__)
+
+
+class ParsedCache:
+    """On-disk cache of parser output.
+
+    Entries are keyed by the sha256 of the parser input along with the parser's
+    name and version, so that a new parser version never reuses stale output.
+    """
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = Path(cache_dir) / "parsed"
+
+    def _path(self, content_hash: str, parser: Component) -> Path:
+        return (
+            self.cache_dir
+            / parser.name
+            / make_uid_path_safe(parser.version)
+            / f"{content_hash}.xml"
+        )
+
+    def get(self, content_hash: str, parser: Component) -> Optional[bytes]:
+        path = self._path(content_hash, parser)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        logger.info(f"Using cached {parser.name} output from {path}")
+        return data
+
+    def put(self, content_hash: str, parser: Component, data: bytes):
+        path = self._path(content_hash, parser)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file and rename it so that concurrent workers or
+        # an interrupted run never leave a partial entry behind.
+        with tempfile.NamedTemporaryFile(
+            dir=path.parent, suffix=".tmp", delete=False
+        ) as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_file.name, path)
+
+
+class MetricsCache:
+    """SQLite store of extractor output.
+
+    Entries are keyed by the sha256 of the parsed document, the parser that
+    produced it, and the extractor's name and version. Once the stored results
+    exceed `max_bytes` the least recently used entries are evicted.
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int = 2**30):
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        self.path = Path(cache_dir) / "metrics.sqlite"
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS metrics (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS metrics_accessed_at ON metrics (accessed_at)"
+            )
+            (self._size,) = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM metrics"
+            ).fetchone()
+
+    @staticmethod
+    def _key(content_hash: str, extractor: Component, parser: str) -> str:
+        return f"{extractor.name}:{extractor.version}:{parser}:{content_hash}"
+
+    def get(
+        self, content_hash: str, extractor: Component, parser: str
+    ) -> Optional[dict]:
+        key = self._key(content_hash, extractor, parser)
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT value FROM metrics WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE metrics SET accessed_at = ? WHERE key = ?", (time.time(), key)
+            )
+        logger.info(f"Using cached {extractor.name} output for {content_hash}")
+        return json.loads(row[0])
+
+    def put(self, content_hash: str, extractor: Component, parser: str, metrics: dict):
+        key = self._key(content_hash, extractor, parser)
+        value = json.dumps(metrics)
+        with self._lock, self._conn:
+            replaced = self._conn.execute(
+                "SELECT size FROM metrics WHERE key = ?", (key,)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time.time()),
+            )
+            self._size += len(value) - (replaced[0] if replaced else 0)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        evicted = []
+        rows = self._conn.execute("SELECT key, size FROM metrics ORDER BY accessed_at")
+        for key, size in rows:
+            if self._size <= self.max_bytes:
+                break
+            evicted.append((key,))
+            self._size -= size
+        self._conn.executemany("DELETE FROM metrics WHERE key = ?", evicted)
+        logger.info(f"Evicted {len(evicted)} entries from {self.path}")
@@ -1,25 +1,57 @@
+import hashlib
+import mmap
 from abc import ABC, abstractmethod
 from pathlib import Path
-from typing import Any, Optional
+from typing import TYPE_CHECKING, Any, Optional
+
+import requests
 
 from osm import schemas
+from osm._http import get_session
+
+if TYPE_CHECKING:
+    from .cache import MetricsCache, ParsedCache
+
+# Document contents are passed between components as bytes or as a zero-copy
+# memoryview, e.g. of a memory-mapped input file.
+Buffer = bytes | memoryview
 
 
 class Component(ABC):
-    def __init__(self, version: str = "0.0.1"):
-        """As subclasses evolve they should keep track of their version."""
+    # Whether the output only depends on the input and the component version
+    # and so can be reused by the pipeline's cache.
+    cacheable = False
+    # Whether the component accepts the path of its input file, along with an
+    # output_path to write its output to, rather than the contents in memory.
+    streams_input = False
+
+    def __init__(
+        self, version: str = "0.0.1", session: Optional[requests.Session] = None
+    ):
+        """As subclasses evolve they should keep track of their version.
+
+        Components talking to a service should use `self.session`, which pools
+        connections and applies timeouts and retries. By default it is shared by
+        every component in the process.
+        """
         self.version = version
+        self.session = session if session is not None else get_session()
         self.docker_image = None
         self.docker_image_id = None
         self._name = None
         self._orm_model = None
 
     @abstractmethod
-    def _run(self, data: bytes | dict, **kwargs) -> Any:
-        """Abstract method that subclasses must implement."""
+    def _run(self, data: Buffer | dict, **kwargs) -> Any:
+        """Abstract method that subclasses must implement.
+
+        Document contents may be a memoryview rather than bytes. It supports
+        hashing, slicing and writing to files without a copy; call bytes(data)
+        where an API requires bytes.
+        """
         pass
 
-    def run(self, data: bytes, *args, **kwargs) -> Any:
+    def run(self, data: Buffer, *args, **kwargs) -> Any:
         print(f"{self.name} (version {self.version}) is running.")
         return self._run(data, *args, **kwargs)
 
@@ -53,26 +85,39 @@ class Component(ABC):
 
 class Savers:
     def __init__(
-        self, file_saver: Component, json_saver: Component, osm_saver: Component
+        self,
+        file_saver: Component,
+        json_saver: Component,
+        osm_saver: Component,
+        parquet_saver: Optional[Component] = None,
     ):
         self.file_saver = file_saver
         self.json_saver = json_saver
         self.osm_saver = osm_saver
+        self.parquet_saver = parquet_saver
 
     def __iter__(self):
         yield self.file_saver
         yield self.json_saver
         yield self.osm_saver
+        if self.parquet_saver is not None:
+            yield self.parquet_saver
 
-    def save_file(self, data: bytes, path: Path):
+    def save_file(self, data: Buffer, path: Path):
         self.file_saver.run(data, path=path)
 
     def save_json(self, data: dict, path: Path):
         self.json_saver.run(data, path=path)
 
+    def save_parquet(self, data: dict, user_defined_id: str, content_hash: str):
+        if self.parquet_saver is not None:
+            self.parquet_saver.run(
+                data, user_defined_id=user_defined_id, content_hash=content_hash
+            )
+
     def save_osm(
         self,
-        data: bytes,
+        data: Buffer,
         metrics: dict,
         components: list,
     ):
@@ -90,6 +135,10 @@ class Pipeline:
         input_path: str,
         xml_path: Optional[str] = None,
         metrics_path: Optional[str] = None,
+        parsed_cache: Optional["ParsedCache"] = None,
+        metrics_cache: Optional["MetricsCache"] = None,
+        uid: Optional[str] = None,
+        mmap_input: bool = True,
     ):
         self.parsers = parsers
         self.extractors = extractors
@@ -98,30 +147,122 @@ class Pipeline:
         self._file_data = None
         self.xml_path = xml_path
         self.metrics_path = metrics_path
+        self.parsed_cache = parsed_cache
+        self.metrics_cache = metrics_cache
+        self.uid = uid
+        self.mmap_input = mmap_input
+        self._content_hash = None
 
     def run(self, user_managed_compose: bool = False):
+        parsed = self.parse(user_managed_compose=user_managed_compose)
+        self.save(self.extract(parsed))
+
+    def parse(self, user_managed_compose: bool = False) -> list[tuple[Component, Any]]:
+        """Run each parser on the input and save parsed text."""
+        parsed = []
         for parser in self.parsers:
+            parsed_data, saved = self._run_parser(parser, user_managed_compose)
+            if isinstance(parsed_data, Buffer) and not saved:
+                self.savers.save_file(parsed_data, self.xml_path)
+            parsed.append((parser, parsed_data))
+        return parsed
+
+    def _run_parser(
+        self, parser: Component, user_managed_compose: bool
+    ) -> tuple[Any, bool]:
+        """Returns the parsed data and whether it was already saved to xml_path."""
+        use_cache = self.parsed_cache is not None and parser.cacheable
+        if use_cache:
+            parsed_data = self.parsed_cache.get(self.content_hash, parser)
+            if parsed_data is not None:
+                return parsed_data, False
+        saved = False
+        if parser.streams_input and self.xml_path is not None:
+            # The parser streams the input file and writes its output to disk
+            # without holding either in memory.
+            output_path = parser.run(
+                Path(self.input_path),
+                user_managed_compose=user_managed_compose,
+                output_path=Path(self.xml_path),
+            )
+            parsed_data = output_path.read_bytes()
+            saved = True
+        else:
             parsed_data = parser.run(
                 self.file_data, user_managed_compose=user_managed_compose
             )
-            if isinstance(parsed_data, bytes):
-                self.savers.save_file(parsed_data, self.xml_path)
-            for extractor in self.extractors:
-                extracted_metrics = extractor.run(parsed_data, parser=parser.name)
-                self.savers.save_osm(
-                    data=self.file_data,
-                    metrics=extracted_metrics,
-                    components=[*self.parsers, *self.extractors, *self.savers],
-                )
-                self.savers.save_json(extracted_metrics, self.metrics_path)
+        if use_cache and isinstance(parsed_data, Buffer):
+            self.parsed_cache.put(self.content_hash, parser, parsed_data)
+        return parsed_data, saved
+
+    def extract(self, parsed: list[tuple[Component, Any]]) -> list[dict]:
+        """Run each extractor on the output of each parser."""
+        return [
+            self._run_extractor(extractor, parsed_data, parser)
+            for parser, parsed_data in parsed
+            for extractor in self.extractors
+        ]
+
+    def _run_extractor(
+        self, extractor: Component, parsed_data: Any, parser: Component
+    ) -> dict:
+        use_cache = (
+            self.metrics_cache is not None
+            and extractor.cacheable
+            and isinstance(parsed_data, Buffer)
+        )
+        if use_cache:
+            parsed_hash = hashlib.sha256(parsed_data).hexdigest()
+            metrics = self.metrics_cache.get(parsed_hash, extractor, parser.name)
+            if metrics is not None:
+                return metrics
+        metrics = extractor.run(parsed_data, parser=parser.name)
+        if use_cache:
+            self.metrics_cache.put(parsed_hash, extractor, parser.name, metrics)
+        return metrics
+
+    def save(self, extracted: list[dict]):
+        """Upload and save the metrics from each extractor."""
+        for extracted_metrics in extracted:
+            self.savers.save_osm(
+                data=self.file_data,
+                metrics=extracted_metrics,
+                components=[*self.parsers, *self.extractors, *self.savers],
+            )
+            self.savers.save_json(extracted_metrics, self.metrics_path)
+            self.savers.save_parquet(
+                extracted_metrics,
+                user_defined_id=self.uid,
+                content_hash=self.content_hash,
+            )
 
     @staticmethod
     def read_file(input_path: str) -> bytes:
         with open(input_path, "rb") as file:
             return file.read()
 
+    @staticmethod
+    def map_file(input_path: str) -> Buffer:
+        """Memory-map the file so that its pages are shared and read on demand."""
+        with open(input_path, "rb") as file:
+            try:
+                # The mapping stays valid after the file is closed
+                return memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+            except ValueError:
+                # Empty files cannot be mapped
+                return b""
+
     @property
-    def file_data(self):
-        if not self._file_data:
-            self._file_data = self.read_file(self.input_path)
+    def file_data(self) -> Buffer:
+        if self._file_data is None:
+            if self.mmap_input:
+                self._file_data = self.map_file(self.input_path)
+            else:
+                self._file_data = self.read_file(self.input_path)
         return self._file_data
+
+    @property
+    def content_hash(self) -> str:
+        if self._content_hash is None:
+            self._content_hash = hashlib.sha256(self.file_data).hexdigest()
+        return self._content_hash
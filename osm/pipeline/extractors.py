@@ -1,16 +1,54 @@
+import functools
 import io
 import logging
 
-import requests
+import pyarrow as pa
 
 from osm.schemas.custom_fields import LongBytes
+from osm.schemas.schema_helpers import get_pyarrow_schema
 
 from .core import Component
 
 logger = logging.getLogger(__name__)
 
+RTRANSPARENT_URL = "http://localhost:8071/extract-metrics/"
+
+
+@functools.cache
+def _metrics_schema() -> pa.Schema:
+    return get_pyarrow_schema()
+
+
+def read_metrics_table(data: bytes) -> pa.Table:
+    """Read an Arrow IPC stream of metrics, typed to the RtransparentMetrics schema.
+
+    Columns outside of the schema, e.g. the error column of batch responses,
+    are kept as they are.
+    """
+    table = pa.ipc.open_stream(pa.py_buffer(data)).read_all()
+    for field in _metrics_schema():
+        if field.name in table.column_names:
+            table = table.set_column(
+                table.column_names.index(field.name),
+                field,
+                table[field.name].cast(field.type),
+            )
+    return table
+
 
 class RTransparentExtractor(Component):
+    cacheable = True
+
+    def __init__(self, version="0.0.1", session=None, response_format="json"):
+        """
+        Args:
+            response_format (str): "json", or "arrow" to receive typed Arrow
+                record batches with missing values as nulls. Arrow responses
+                need a version of the rtransparent image that supports them.
+        """
+        super().__init__(version=version, session=session)
+        self.response_format = response_format
+
     def _run(self, data: bytes, parser: str = None) -> dict:
         self.sample = LongBytes(data)
 
@@ -18,20 +56,23 @@ class RTransparentExtractor(Component):
         files = {"file": ("input.xml", io.BytesIO(data), "application/xml")}
 
         # Send the request with the file
-        response = requests.post(
-            "http://localhost:8071/extract-metrics/",
+        response = self.session.post(
+            RTRANSPARENT_URL,
             files=files,
-            params={"parser": parser},
+            params={"parser": parser, "format": self.response_format},
         )
 
         if response.status_code == 200:
-            metrics = response.json()
+            if self.response_format == "arrow":
+                [metrics] = read_metrics_table(response.content).to_pylist()
+            else:
+                metrics = response.json()
+                # Replace NA value, older images return it as is
+                for k, v in metrics.items():
+                    if v == -2147483648:
+                        metrics[k] = None
             # pmid only exists when input filename is correct
             metrics.pop("pmid", None)  # Use .pop() with a default to avoid KeyError
-            # Replace NA value
-            for k, v in metrics.items():
-                if v == -2147483648:
-                    metrics[k] = None
             return metrics
         else:
             logger.error(f"Error: {response.text}")
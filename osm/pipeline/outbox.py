@@ -0,0 +1,208 @@
+"""
+A durable queue of invocations waiting to be uploaded to the OSM API.
+
+Invocations are written to a SQLite database and the pipeline moves on while a
+background thread uploads them in batches. Each invocation gets an id derived
+from its work, the client's email, the comment and the components of the
+pipeline, so uploading it again, e.g. after a crash between its upload and its
+removal from the outbox, is reported by the API as a duplicate. Invocations still queued
+when a run ends are uploaded by the next run that uses the same outbox.
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import requests
+
+from osm._http import get_session
+
+from .savers import MAX_BATCH_BYTES, get_osm_api, quarantine, upload_invocations
+
+logger = logging.getLogger(__name__)
+
+
+def idempotency_key(invocation: dict) -> str:
+    # Everything identifying the record except created_at and the metrics,
+    # which may differ when the same document is processed again. The
+    # compute_context_id of the client comes from the salted hash() so it
+    # differs between processes and only the email is used.
+    identity = {
+        "work": invocation["work"],
+        "email": invocation["client"].get("email"),
+        "user_comment": invocation.get("user_comment"),
+        "components": [
+            f"{component['name']}:{component['version']}"
+            for component in invocation["components"]
+        ],
+    }
+    key = json.dumps(identity, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def is_permanent(error: requests.HTTPError) -> bool:
+    # Client errors fail again on retry, except for timeouts and rate limits
+    status = error.response.status_code if error.response is not None else None
+    return status is not None and 400 <= status < 500 and status not in (408, 429)
+
+
+class Outbox:
+    """Persist invocations and upload them in the background."""
+
+    def __init__(
+        self,
+        path: Path,
+        batch_size: int = 100,
+        max_wait: float = 30,
+        max_delay: float = 300,
+        session: Optional[requests.Session] = None,
+        max_batch_bytes: int = MAX_BATCH_BYTES,
+    ):
+        """
+        Args:
+            path (Path): The SQLite database holding the queued invocations.
+            batch_size (int): Invocations uploaded with each request.
+            max_wait (float): Seconds before a partial batch is uploaded.
+            max_delay (float): Upper bound on the wait between failed uploads.
+            session (requests.Session): Pooled session used for the uploads.
+            max_batch_bytes (int): Upper bound on the JSON size of a batch,
+                which is held in memory while it is uploaded.
+        """
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = Path(path)
+        self.osm_api = get_osm_api()
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.max_delay = max_delay
+        self.max_batch_bytes = max_batch_bytes
+        self.session = session if session is not None else get_session()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS outbox (
+                    key TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+        self._wake = threading.Event()
+        self._closing = threading.Event()
+        self._stopped = threading.Event()
+        self._drainer = threading.Thread(target=self._drain, daemon=True)
+        self._drainer.start()
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM outbox").fetchone()
+        return count
+
+    def add(self, invocation: dict):
+        """Queue a validated invocation for upload."""
+        key = idempotency_key(invocation)
+        # An ObjectId is 12 bytes
+        invocation = {**invocation, "id": key[:24]}
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO outbox VALUES (?, ?, ?)",
+                (key, json.dumps(invocation), time.time()),
+            )
+        self._wake.set()
+
+    def close(self, timeout: float = 60):
+        """Wait up to timeout seconds for the queued invocations to be uploaded."""
+        self._closing.set()
+        self._wake.set()
+        self._drainer.join(timeout)
+        self._stopped.set()
+        self._drainer.join()
+        remaining = len(self)
+        if remaining:
+            print(
+                f"{remaining} invocations remain in {self.path} and will be "
+                "uploaded by the next run"
+            )
+        self._conn.close()
+
+    def _next_batch(self) -> tuple[list[tuple[str, str, float]], bool]:
+        """The oldest invocations, up to the batch limits, and whether the
+        batch is full."""
+        with self._lock:
+            # Sized without reading the payloads, which are ASCII JSON
+            sizes = self._conn.execute(
+                "SELECT key, length(payload) FROM outbox ORDER BY created_at LIMIT ?",
+                (self.batch_size,),
+            ).fetchall()
+            keys, batch_bytes = [], 0
+            for key, size in sizes:
+                if keys and batch_bytes + size > self.max_batch_bytes:
+                    break
+                keys.append(key)
+                batch_bytes += size
+            batch = self._conn.execute(
+                "SELECT key, payload, created_at FROM outbox WHERE key IN "
+                f"({','.join('?' * len(keys))}) ORDER BY created_at",
+                keys,
+            ).fetchall()
+        full = len(sizes) == self.batch_size or len(keys) < len(sizes)
+        return batch, full
+
+    def _drain(self):
+        delay = 1
+        while not self._stopped.is_set():
+            batch, full = self._next_batch()
+            if not batch and self._closing.is_set():
+                return
+            waited = time.time() - batch[0][2] if batch else 0
+            full = full or self._closing.is_set()
+            if not full and (not batch or waited < self.max_wait):
+                self._wake.wait(self.max_wait - waited)
+                self._wake.clear()
+                continue
+            try:
+                self._send(batch)
+            except Exception as e:
+                # Keep the batch, e.g. while the API is unavailable
+                logger.warning(
+                    f"Upload from the outbox failed, retrying in {delay}s: {e}"
+                )
+                self._stopped.wait(delay)
+                delay = min(delay * 2, self.max_delay)
+                continue
+            delay = 1
+
+    def _send(self, batch):
+        """
+        Upload a batch and remove it from the outbox.
+
+        A batch rejected by the API with a client error is split in halves as
+        retrying it would fail in the same way, and an invocation rejected on
+        its own is quarantined so it does not block the rest of the queue.
+        Other errors are raised so the batch is retried later.
+        """
+        invocations = [json.loads(payload) for _, payload, _ in batch]
+        try:
+            # Rejected invocations are quarantined so all are done
+            upload_invocations(self.session, self.osm_api, invocations)
+        except requests.HTTPError as e:
+            if not is_permanent(e):
+                raise
+            if len(batch) > 1:
+                middle = len(batch) // 2
+                self._send(batch[:middle])
+                self._send(batch[middle:])
+                return
+            logger.warning(f"Quarantining an invocation rejected by the API: {e}")
+            quarantine(self.session, self.osm_api, invocations[0], str(e))
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "DELETE FROM outbox WHERE key = ?", [(key,) for key, _, _ in batch]
+            )
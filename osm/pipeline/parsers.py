@@ -1,19 +1,21 @@
-import io
-import time
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional
 
-import requests
+from osm._http import wait_for_service
+from osm.schemas.custom_fields import FileRef, LongBytes
 
-from osm.schemas.custom_fields import LongBytes
-
-from .core import Component
+from .core import Buffer, Component
 
 SCIENCEBEAM_URL = "http://localhost:8070/api/convert"
+CHUNK_SIZE = 2**16
 
 
 class NoopParser(Component):
     """Used if the input is xml and so needs no parsing."""
 
-    def _run(self, data: bytes) -> bytes:
+    def _run(self, data: Buffer, user_managed_compose=False) -> Buffer:
         return data
 
 
@@ -30,21 +32,54 @@ class PMCParser(NoopParser):
 
 
 class ScienceBeamParser(Component):
-    def _run(self, data: bytes, user_managed_compose=False) -> str:
-        self.sample = LongBytes(data)
+    cacheable = True
+    streams_input = True
+
+    def _run(
+        self,
+        data: Buffer | Path,
+        user_managed_compose=False,
+        output_path: Optional[Path] = None,
+    ) -> bytes | Path:
+        """Convert a pdf to TEI xml.
+
+        The pdf is sent as the raw request body, which requests streams from
+        disk when data is a path. With an output_path the TEI is streamed to
+        that file and the path is returned, otherwise its content is returned.
+        """
         headers = {"Accept": "application/tei+xml", "Content-Type": "application/pdf"}
-        files = {"file": ("input.pdf", io.BytesIO(data), "application/pdf")}
-        for attempt in range(5):
-            try:
-                if not user_managed_compose:
-                    time.sleep(10)
-                response = requests.post(SCIENCEBEAM_URL, files=files, headers=headers)
-            except requests.exceptions.RequestException:
-                print(
-                    f"Attempt {attempt + 1} for parsing the file failed. This can happen while the container is starting up. Retrying in 5 seconds."
+        if not user_managed_compose:
+            # The container may still be starting up
+            wait_for_service("sciencebeam")
+        stream = output_path is not None
+        if isinstance(data, Path):
+            self.sample = FileRef(data)
+            with data.open("rb") as pdf:
+                response = self.session.post(
+                    SCIENCEBEAM_URL, data=pdf, headers=headers, stream=stream
                 )
-                continue
-            if response.status_code == 200:
-                return response.content
-            else:
+        else:
+            self.sample = LongBytes(data)
+            # requests would iterate over a memoryview body
+            response = self.session.post(
+                SCIENCEBEAM_URL, data=bytes(data), headers=headers, stream=stream
+            )
+        with response:
+            if response.status_code != 200:
                 response.raise_for_status()
+            if not stream:
+                return response.content
+            # Written under a temporary name so a failed stream does not leave
+            # a truncated TEI at output_path, which a rerun would not replace
+            with tempfile.NamedTemporaryFile(
+                dir=output_path.parent, prefix=f".{output_path.name}.", delete=False
+            ) as tei:
+                try:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        tei.write(chunk)
+                except BaseException:
+                    tei.close()
+                    os.unlink(tei.name)
+                    raise
+            os.replace(tei.name, output_path)
+        return output_path
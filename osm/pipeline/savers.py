@@ -1,19 +1,30 @@
 import base64
+import datetime
 import getpass
 import hashlib
 import json
 import logging
 import os
+import threading
+import time
 import traceback
+import uuid
+import zlib
+from collections.abc import Sequence
 from pathlib import Path
+from typing import Optional
 
-import dill
+import pyarrow as pa
+import pyarrow.parquet as pq
 import requests
-from pydantic import ValidationError
+from pydantic import BaseModel, ValidationError
 
 from osm import schemas
+from osm._http import get_session
 from osm._utils import get_compute_context_id
 from osm._version import __version__
+from osm.schemas.custom_fields import LongField
+from osm.schemas.schema_helpers import get_pyarrow_schema
 
 from .core import Component
 
@@ -24,6 +35,94 @@ def format_error_message() -> str:
     return traceback.format_exc().replace(getpass.getuser(), "USER")
 
 
+def get_osm_api() -> str:
+    return os.environ.get("OSM_API", "https://opensciencemetrics.org/api")
+
+
+QUARANTINE_FORMAT = "osm-quarantine/1"
+# Strings longer than this are truncated in quarantined payloads
+QUARANTINE_MAX_CHARS = 2**16
+# Documents are only included while their total size stays below this
+QUARANTINE_MAX_BLOB_BYTES = 2**22
+
+
+def encode_quarantine_payload(
+    payload,
+    max_chars: int = QUARANTINE_MAX_CHARS,
+    max_blob_bytes: int = QUARANTINE_MAX_BLOB_BYTES,
+) -> bytes:
+    """Encode a payload as compressed JSON of bounded size.
+
+    Bytes, such as the documents held in component samples, are replaced by
+    references to their sha256 and each distinct document is stored once
+    alongside the payload, as long as the documents stay below max_blob_bytes
+    in total. Use decode_quarantine_payload to read the result.
+    """
+    blobs = {}
+
+    def encode(value):
+        if isinstance(value, BaseModel):
+            return {
+                name: encode(getattr(value, name)) for name in type(value).model_fields
+            }
+        if isinstance(value, dict):
+            return {str(k): encode(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [encode(v) for v in value]
+        if isinstance(value, LongField):
+            return encode(value.get_value())
+        if isinstance(value, (bytes, memoryview)):
+            digest = hashlib.sha256(value).hexdigest()
+            if len(value) <= max_blob_bytes:
+                # Not copied, the document is read again when base64 encoded
+                blobs[digest] = value
+            return {"$blob": digest, "size": len(value)}
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            return value.isoformat()
+        if value is None or isinstance(value, (bool, int, float)):
+            return value
+        value = str(value)
+        if len(value) > max_chars:
+            return f"{value[:max_chars]}... ({len(value)} characters)"
+        return value
+
+    encoded = {"format": QUARANTINE_FORMAT, "payload": encode(payload), "blobs": {}}
+    total = 0
+    for digest, blob in sorted(blobs.items(), key=lambda item: len(item[1])):
+        total += len(blob)
+        if total > max_blob_bytes:
+            break
+        encoded["blobs"][digest] = base64.b64encode(blob).decode("utf-8")
+    return zlib.compress(json.dumps(encoded).encode())
+
+
+def decode_quarantine_payload(data: bytes) -> dict:
+    """Return the payload and documents encoded by encode_quarantine_payload."""
+    decoded = json.loads(zlib.decompress(data))
+    decoded["blobs"] = {
+        digest: base64.b64decode(blob) for digest, blob in decoded["blobs"].items()
+    }
+    return decoded
+
+
+def quarantine(session, osm_api: str, payload, error_message: str):
+    """Store a payload that could not be uploaded for later inspection."""
+    encoded = encode_quarantine_payload(payload)
+    try:
+        failure = schemas.Quarantine(
+            payload=base64.b64encode(encoded).decode("utf-8"),
+            error_message=error_message,
+        ).model_dump(mode="json", exclude=["id"])
+        response = session.put(f"{osm_api}/quarantine/", json=failure)
+        response.raise_for_status()
+    except Exception:
+        session.put(
+            f"{osm_api}/quarantine2/",
+            files={"file": encoded},
+            data={"error_message": error_message},
+        )
+
+
 class FileSaver(Component):
     """Basic saver that writes data to a file."""
 
@@ -53,10 +152,248 @@ class JSONSaver(Component):
         print(f"Metrics saved to {path}")
 
 
+class ParquetSaver(Component):
+    """Saver that appends metrics to a partitioned Parquet dataset."""
+
+    # Columns identifying the work, stored alongside the metrics
+    work_fields = [
+        pa.field("user_defined_id", pa.string()),
+        pa.field("content_hash", pa.string()),
+    ]
+
+    def __init__(
+        self,
+        path: Path,
+        partition_cols: Sequence[str] = ("year",),
+        buffer_size: int = 1000,
+    ):
+        """Buffer metrics in memory and flush them to the dataset in batches.
+
+        Each flush adds a file to every partition it has rows for, so the
+        buffer size sets the size of the files. The saver is shared between
+        pipelines and must be closed to write the rows still buffered.
+
+        Args:
+            path (Path): Root directory of the dataset.
+            partition_cols (Sequence[str]): Columns used for the hive style
+                partition directories, e.g. year=2020.
+            buffer_size (int): Rows to buffer before writing them out.
+        """
+        super().__init__()
+        self.path = Path(path)
+        self.partition_cols = list(partition_cols)
+        self.buffer_size = buffer_size
+        self.schema = pa.schema([*get_pyarrow_schema(), *self.work_fields])
+        unknown = set(self.partition_cols) - set(self.schema.names)
+        if unknown:
+            raise ValueError(f"Cannot partition by unknown columns: {unknown}")
+        self._rows = []
+        self._lock = threading.Lock()
+
+    def _run(self, data: dict, user_defined_id: str, content_hash: str):
+        """Add the metrics of a work to the buffer.
+
+        Args:
+            data (dict): Metrics conformant to a schema.
+            user_defined_id (str): Identifier of the work.
+            content_hash (str): Hash of the input document.
+        """
+        row = {**data, "user_defined_id": user_defined_id, "content_hash": content_hash}
+        # Converted here so that a row that does not fit the schema fails the
+        # save of its own document rather than a later flush
+        row = pa.Table.from_pylist([row], schema=self.schema)
+        with self._lock:
+            self._rows.append(row)
+            if len(self._rows) < self.buffer_size:
+                return
+            rows, self._rows = self._rows, []
+        self.flush(rows)
+
+    def flush(self, rows: list[pa.Table]):
+        if not rows:
+            return
+        try:
+            pq.write_to_dataset(
+                pa.concat_tables(rows),
+                root_path=self.path,
+                partition_cols=self.partition_cols,
+                # Unique names so that flushes never overwrite each other
+                basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+                existing_data_behavior="overwrite_or_ignore",
+            )
+        except Exception:
+            # Keep the rows for the next flush
+            with self._lock:
+                self._rows[:0] = rows
+            raise
+        logger.info(f"{len(rows)} rows of metrics saved to {self.path}")
+
+    def close(self):
+        """Write out any buffered rows."""
+        with self._lock:
+            rows, self._rows = self._rows, []
+        self.flush(rows)
+        print(f"Metrics dataset saved to {self.path}")
+
+
+# Batch upload results for invocations that are stored by the OSM API
+UPLOADED = ("inserted", "duplicate")
+# Invocations carry their documents as base64, so batches are also limited in
+# size to keep requests, and the memory holding them, bounded
+MAX_BATCH_BYTES = 16 * 2**20
+
+
+def upload_invocations(session, osm_api: str, invocations: list[dict]) -> list[dict]:
+    """Upload invocations with one request, quarantining those that are rejected.
+
+    Returns:
+        list[dict]: The result for each invocation, in order.
+    """
+    try:
+        response = session.put(f"{osm_api}/upload/batch/", json=invocations)
+    except requests.exceptions.ConnectionError:
+        raise EnvironmentError(f"Cannot connect to OSM API ({osm_api})")
+    response.raise_for_status()
+    results = response.json()["results"]
+    for result in results:
+        if result["status"] not in UPLOADED:
+            logger.error(f"Invocation rejected by the OSM API: {result['error']}")
+            quarantine(session, osm_api, invocations[result["index"]], result["error"])
+    logger.info(f"{len(invocations)} invocations sent to {osm_api}")
+    return results
+
+
+class UploadBuffer:
+    """Upload invocations to the OSM API in batches.
+
+    A batch is sent once it holds batch_size invocations or max_batch_bytes of
+    JSON, or its first invocation has waited max_wait seconds. A single
+    invocation larger than max_batch_bytes is sent on its own. Invocations
+    rejected by the API are
+    quarantined. The buffer is shared between pipelines and must be closed to
+    upload the invocations still buffered.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = 100,
+        max_wait: float = 30,
+        session: Optional[requests.Session] = None,
+        max_batch_bytes: int = MAX_BATCH_BYTES,
+    ):
+        """
+        Args:
+            batch_size (int): Invocations uploaded with each request.
+            max_wait (float): Seconds an invocation may wait in the buffer.
+            session (requests.Session): Pooled session used for the uploads.
+            max_batch_bytes (int): Upper bound on the JSON size of a batch.
+        """
+        self.osm_api = get_osm_api()
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.session = session if session is not None else get_session()
+        self.max_batch_bytes = max_batch_bytes
+        self.uploaded = 0
+        self.rejected = 0
+        self._invocations = []
+        self._sizes = []
+        self._first_added = None
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._timer = threading.Thread(target=self._upload_when_due, daemon=True)
+        self._timer.start()
+
+    def add(self, invocation: dict):
+        """Buffer a validated invocation, uploading a batch if one is full."""
+        size = len(json.dumps(invocation))
+        with self._lock:
+            self._invocations.append(invocation)
+            self._sizes.append(size)
+            if self._first_added is None:
+                self._first_added = time.monotonic()
+            if (
+                len(self._invocations) < self.batch_size
+                and sum(self._sizes) < self.max_batch_bytes
+            ):
+                return
+            invocations = self._take()
+        self._upload(invocations)
+
+    def close(self):
+        """Stop the timer and upload the remaining invocations."""
+        self._closed.set()
+        self._timer.join()
+        while True:
+            with self._lock:
+                invocations = self._take()
+            if not invocations or not self._upload(invocations):
+                break
+        print(
+            f"{self.uploaded} invocations uploaded, {self.rejected} rejected by the OSM API"
+        )
+        if self._invocations:
+            print(f"{len(self._invocations)} invocations could not be uploaded")
+
+    def _take(self) -> list[dict]:
+        count = batch_bytes = 0
+        for size in self._sizes[: self.batch_size]:
+            if count and batch_bytes + size > self.max_batch_bytes:
+                break
+            count += 1
+            batch_bytes += size
+        invocations = self._invocations[:count]
+        self._invocations = self._invocations[count:]
+        self._sizes = self._sizes[count:]
+        self._first_added = time.monotonic() if self._invocations else None
+        return invocations
+
+    def _upload_when_due(self):
+        while not self._closed.wait(min(self.max_wait, 1)):
+            with self._lock:
+                due = (
+                    self._first_added is not None
+                    and time.monotonic() - self._first_added >= self.max_wait
+                )
+                invocations = self._take() if due else []
+            self._upload(invocations)
+
+    def _upload(self, invocations: list[dict]) -> bool:
+        """Upload a batch, returning it to the buffer if the upload fails."""
+        if not invocations:
+            return True
+        try:
+            results = upload_invocations(self.session, self.osm_api, invocations)
+        except Exception as e:
+            # The batch holds the invocations of other documents too, so
+            # keep it for a later upload rather than failing this document
+            logger.warning(
+                f"Upload of {len(invocations)} invocations failed, retrying later: {e}"
+            )
+            with self._lock:
+                self._invocations[:0] = invocations
+                self._sizes[:0] = [len(json.dumps(i)) for i in invocations]
+                self._first_added = time.monotonic()
+            return False
+        uploaded = sum(result["status"] in UPLOADED for result in results)
+        # Uploads happen on the timer thread and the pipeline worker threads
+        with self._lock:
+            self.uploaded += uploaded
+            self.rejected += len(results) - uploaded
+        return True
+
+
 class OSMSaver(Component):
     """A class to gather savers to run a pipeline."""
 
-    def __init__(self, comment, email, user_defined_id, filename):
+    def __init__(
+        self,
+        comment,
+        email,
+        user_defined_id,
+        filename,
+        session=None,
+        upload_buffer=None,
+    ):
         """Upload data to the OSM API.
 
         Args:
@@ -64,13 +401,18 @@ class OSMSaver(Component):
             email (str): For users to be contactable for future data curation etc.
             user_defined_id (str): pmid, pmcid, doi, or other unique identifier.
             filename (str): Name of the file being processed.
+            session (requests.Session): Pooled session used for the uploads.
+            upload_buffer (UploadBuffer | Outbox): Hand validated invocations
+                to a buffer or outbox that uploads them in batches rather than
+                making one request per invocation.
         """
-        super().__init__()
+        super().__init__(session=session)
         self.compute_context_id = get_compute_context_id()
         self.comment = comment
         self.email = email
         self.user_defined_id = user_defined_id
         self.filename = filename
+        self.upload_buffer = upload_buffer
 
     def _run(self, data: bytes, metrics: dict, components: list[schemas.Component]):
         """Save the extracted metrics to the OSM API.
@@ -80,7 +422,7 @@ class OSMSaver(Component):
             metrics: Schema conformant metrics.
             components: parsers, extractors, and savers that constitute the pipeline.
         """
-        osm_api = os.environ.get("OSM_API", "https://opensciencemetrics.org/api")
+        osm_api = get_osm_api()
         print(f"Using OSM API: {osm_api}")
         # Build the payload
         try:
@@ -100,7 +442,7 @@ class OSMSaver(Component):
                 "components": [comp.orm_model for comp in components],
             }
         except Exception as e:
-            requests.put(
+            self.session.put(
                 f"{osm_api}/payload_error/",
                 json=schemas.PayloadError(
                     error_message=format_error_message(),
@@ -110,13 +452,21 @@ class OSMSaver(Component):
         try:
             # Validate the payload
             validated_data = schemas.Invocation(**payload)
+            if self.upload_buffer is not None:
+                self.upload_buffer.add(
+                    validated_data.model_dump(mode="json", exclude=["id"])
+                )
+                return
             # If validation passes, send POST request to OSM API. ID is not
-            # serializable but can be excluded and created by the DB. All types
-            # should be serializable. If they're not then they should be encoded
-            # as a string or something like that: base64.b64encode(bytes).decode("utf-8")
-            response = requests.put(
+            # serializable but can be excluded and created by the DB. Samples
+            # are base64 encoded straight into the JSON body, rather than into
+            # a dict by model_dump and then copied again by requests' json=.
+            response = self.session.put(
                 f"{osm_api}/upload/",
-                json=validated_data.model_dump(mode="json", exclude=["id"]),
+                data=validated_data.__pydantic_serializer__.to_json(
+                    validated_data, exclude={"id"}
+                ),
+                headers={"Content-Type": "application/json"},
             )
             if response.status_code == 200:
                 print("Invocation data uploaded successfully")
@@ -128,18 +478,6 @@ class OSMSaver(Component):
             raise EnvironmentError(f"Cannot connect to OSM API ({osm_api})")
         except (ValidationError, ValueError) as e:
             try:
-                # Quarantine the failed payload
-                failure = schemas.Quarantine(
-                    payload=base64.b64encode(dill.dumps(payload)).decode("utf-8"),
-                    error_message=format_error_message(),
-                ).model_dump(mode="json", exclude=["id"])
-                response = requests.put(f"{osm_api}/quarantine/", json=failure)
-                response.raise_for_status()
-            except Exception:
-                requests.put(
-                    f"{osm_api}/quarantine2/",
-                    files={"file": dill.dumps(payload)},
-                    data={"error_message": format_error_message()},
-                )
+                quarantine(self.session, osm_api, payload, format_error_message())
             finally:
                 raise e
@@ -1,3 +1,4 @@
+from pathlib import Path
 from typing import Any, ClassVar, Generic, TypeVar, Union
 
 import odmantic
@@ -88,6 +89,16 @@ class LongBytes(LongField[bytes]):
     _error_kind: ClassVar[str] = "bytes_type"
 
 
+class FileRef(LongBytes):
+    """Bytes of a file, read from disk on demand."""
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def get_value(self) -> bytes:
+        return self.path.read_bytes()
+
+
 class FilePlaceholder(odmantic.EmbeddedModel):
     content: LongBytes = odmantic.Field(
         default=b"", json_schema_extra={"exclude": True}
@@ -1,17 +1,28 @@
+import datetime
+import functools
+import itertools
+import json
 import logging
 import os
+import typing
+import uuid
 import warnings
 from collections.abc import Iterator
+from pathlib import Path
 
 import pandas as pd
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 from odmantic import SyncEngine
 from pydantic import ValidationError
 from pymongo import MongoClient
 
 from osm import __version__, schemas
-from osm._utils import flatten_dict
+from osm._utils import coerce_to_string, flatten_dict
 from osm.schemas import Client, Invocation, RtransparentMetrics, Work
+from osm.schemas.custom_fields import LongStr
 
 logger = logging.getLogger(__name__)
 
@@ -30,6 +41,18 @@ def theneuro_data_processing(row):
     return row
 
 
+# The column renames made by each of the custom processing functions, which
+# allow them to be applied to whole batches by transform_data.
+COLUMN_RENAMES = {
+    "irp_data_processing": {},
+    "rtransparent_pub_data_processing": {
+        "is_code_pred": "is_open_code",
+        "is_data_pred": "is_open_data",
+    },
+    "theneuro_data_processing": {},
+}
+
+
 def types_mapper(pa_type):
     if pa.types.is_int64(pa_type):
         # Map pyarrow int64 to pandas Int64 (nullable integer)
@@ -118,20 +141,187 @@ def transform_data(table: pa.Table, raise_error=True, **kwargs) -> Iterator[dict
     """
     Process each row in a PyArrow Table in a memory-efficient way and yield JSON payloads.
     """
-    # Iterate over the table in batches
-    for batch in table.to_batches(max_chunksize=500):
-        # Convert the batch to a list of dictionaries (one row at a time)
-        for row in batch.to_pylist():
-            try:
-                # Process each row using the existing get_invocation logic
-                invocation = get_invocation(row, **kwargs)
-                yield invocation.model_dump(mode="json", exclude="id")
-            except (KeyError, ValidationError) as e:
-                if raise_error:
-                    logger.error(f"Error processing row: {row}")
-                    raise e
-                logger.error(f"Skipping row due to error: {e}")
-                continue
+    for invocations in transform_batches(table, raise_error=raise_error, **kwargs):
+        yield from invocations
+
+
+def transform_batches(
+    table: pa.Table, raise_error=True, batch_size=500, **kwargs
+) -> Iterator[list[dict]]:
+    """
+    Yield the JSON payloads of the invocations in batches.
+
+    Columns are checked and converted to the metrics schema with Arrow compute
+    kernels. Only rows holding values that need pydantic's coercion, e.g. a
+    string in an integer column, are validated by building the models with
+    get_invocation. The payloads are the same either way.
+    """
+    for batch in table.to_batches(max_chunksize=batch_size):
+        yield _transform_batch(pa.Table.from_batches([batch]), raise_error, **kwargs)
+
+
+@functools.cache
+def _metrics_schema() -> pa.Schema:
+    return get_pyarrow_schema()
+
+
+@functools.cache
+def _long_str_fields() -> set[str]:
+    return {
+        name
+        for name, field in RtransparentMetrics.model_fields.items()
+        if LongStr in typing.get_args(field.annotation)
+    }
+
+
+def _is_compatible(source: pa.DataType, target: pa.DataType) -> bool:
+    """Whether pydantic accepts every value of the source type as it is."""
+    if pa.types.is_null(source):
+        return True
+    if pa.types.is_boolean(target):
+        return pa.types.is_boolean(source)
+    if pa.types.is_integer(target):
+        return pa.types.is_integer(source)
+    if pa.types.is_floating(target):
+        return pa.types.is_integer(source) or pa.types.is_floating(source)
+    if pa.types.is_string(target):
+        return pa.types.is_string(source) or pa.types.is_large_string(source)
+    return False
+
+
+def _metrics_columns(table: pa.Table) -> tuple[pa.Table, pa.ChunkedArray]:
+    """
+    Convert the columns of the table to the metrics schema.
+
+    Returns:
+    - pa.Table: The metrics, with nulls where values could not be converted.
+    - pa.ChunkedArray: Whether each row needs to be validated by pydantic.
+    """
+    n = table.num_rows
+    needs_validation = pa.chunked_array([pa.array([False] * n)])
+    columns = []
+    for field in _metrics_schema():
+        if field.name not in table.column_names:
+            if RtransparentMetrics.model_fields[field.name].is_required():
+                needs_validation = pa.chunked_array([pa.array([True] * n)])
+            columns.append(pa.nulls(n, field.type))
+            continue
+        column = table[field.name]
+        if _is_compatible(column.type, field.type):
+            column = column.cast(field.type)
+            if field.name in _long_str_fields():
+                # Empty LongStr values are serialized as None
+                column = pc.if_else(pc.equal(column, ""), None, column)
+            columns.append(column)
+        elif pa.types.is_integer(field.type) and pa.types.is_floating(column.type):
+            # pydantic accepts floats without a fractional part as integers
+            integral = pc.and_(pc.is_finite(column), pc.equal(pc.trunc(column), column))
+            needs_validation = pc.or_(
+                needs_validation, pc.and_(pc.is_valid(column), pc.invert(integral))
+            )
+            columns.append(pc.if_else(integral, column, None).cast(field.type))
+        else:
+            needs_validation = pc.or_(needs_validation, pc.is_valid(column))
+            columns.append(pa.nulls(n, field.type))
+    metrics = pa.table(columns, schema=_metrics_schema())
+    return metrics, pc.fill_null(needs_validation, True)
+
+
+def _rename_columns(table: pa.Table, renames: dict[str, str]) -> pa.Table:
+    # Renamed columns replace any existing columns of the same name
+    table = table.drop_columns(
+        [name for name in renames.values() if name in table.column_names]
+    )
+    return table.rename_columns(
+        [renames.get(name, name) for name in table.column_names]
+    )
+
+
+def _transform_batch(table: pa.Table, raise_error: bool, **kwargs) -> list[dict]:
+    custom_processing = kwargs.get("custom_processing")
+    renames = COLUMN_RENAMES.get(custom_processing, {})
+    if (custom_processing is not None and custom_processing not in COLUMN_RENAMES) or (
+        set(renames) - set(table.column_names)
+    ):
+        # Process the rows one at a time, which raises for missing columns
+        return _validate_rows(table.to_pylist(), raise_error, **kwargs)
+
+    renamed = _rename_columns(table, renames)
+    metrics, needs_validation = _metrics_columns(renamed)
+    funders = [None] * table.num_rows
+    if "funder" in table.column_names:
+        funder = table["funder"]
+        if pa.types.is_string(funder.type):
+            funders = [[f] if f is not None else None for f in funder.to_pylist()]
+        elif pa.types.is_list(funder.type) and pa.types.is_string(
+            funder.type.value_type
+        ):
+            funders = funder.to_pylist()
+        elif not pa.types.is_null(funder.type):
+            needs_validation = pc.or_(needs_validation, pc.is_valid(funder))
+    pmids = (
+        table["pmid"].to_pylist()
+        if "pmid" in table.column_names
+        else [None] * table.num_rows
+    )
+
+    template = _template_invocation(**kwargs)
+    invocations = []
+    needs_validation = needs_validation.to_pylist()
+    for i, row_metrics in enumerate(metrics.to_pylist()):
+        if needs_validation[i]:
+            invocations.extend(
+                _validate_rows(table.slice(i, 1).to_pylist(), raise_error, **kwargs)
+            )
+            continue
+        invocations.append(
+            {
+                **template,
+                "metrics": row_metrics,
+                "components": [dict(c) for c in template["components"]],
+                "work": {
+                    **template["work"],
+                    "user_defined_id": coerce_to_string(pmids[i]),
+                    "pmid": row_metrics["pmid"],
+                    "doi": row_metrics["doi"],
+                    "filename": row_metrics["filename"] or "",
+                },
+                "client": dict(template["client"]),
+                "funder": funders[i],
+                "data_tags": list(template["data_tags"]),
+                # Set for each row, as building the model does
+                "created_at": _created_at(),
+            }
+        )
+    return invocations
+
+
+def _created_at() -> str:
+    # The JSON form of Invocation.created_at's default
+    return datetime.datetime.now(datetime.UTC).isoformat().replace("+00:00", "Z")
+
+
+def _template_invocation(**kwargs) -> dict:
+    """The payload fields that are the same for every row."""
+    return get_invocation(
+        {"is_open_code": None, "is_open_data": None},
+        **{**kwargs, "custom_processing": None},
+    ).model_dump(mode="json", exclude="id")
+
+
+def _validate_rows(rows: list[dict], raise_error: bool, **kwargs) -> list[dict]:
+    invocations = []
+    for row in rows:
+        try:
+            # Process each row using the existing get_invocation logic
+            invocation = get_invocation(row, **kwargs)
+            invocations.append(invocation.model_dump(mode="json", exclude="id"))
+        except (KeyError, ValidationError) as e:
+            if raise_error:
+                logger.error(f"Error processing row: {row}")
+                raise e
+            logger.error(f"Skipping row due to error: {e}")
+    return invocations
 
 
 def get_invocation(row, **kwargs):
@@ -171,36 +361,380 @@ def get_invocation(row, **kwargs):
     return invocation
 
 
-def get_data_from_mongo(aggregation: list[dict] | None = None) -> Iterator[dict]:
-    if aggregation is None:
-        aggregation = [
-            {
-                "$match": {"metrics_group": {"$regex": "R"}},
-            },
-            {
-                "$project": {
-                    # "osm_version": True,
-                    "funder": True,
-                    "data_tags": True,
-                    "work.pmid": True,
-                    "metrics.year": True,
-                    "metrics.is_open_data": True,
-                    "metrics.is_open_code": True,
-                    "metrics.affiliation_country": True,
-                    "metrics.journal": True,
-                    "created_at": True,
-                },
-            },
-        ]
+# The invocation fields used by the dashboard
+DASHBOARD_AGGREGATION = [
+    {
+        "$match": {"metrics_group": {"$regex": "R"}},
+    },
+    {
+        "$project": {
+            # "osm_version": True,
+            "funder": True,
+            "data_tags": True,
+            "work.pmid": True,
+            "metrics.year": True,
+            "metrics.is_open_data": True,
+            "metrics.is_open_code": True,
+            "metrics.affiliation_country": True,
+            "metrics.journal": True,
+            "created_at": True,
+        },
+    },
+]
+
+# Types of the flattened invocation fields that are not metrics
+INVOCATION_FIELD_TYPES = {
+    "funder": pa.list_(pa.string()),
+    "data_tags": pa.list_(pa.string()),
+    "created_at": pa.timestamp("us", tz="UTC"),
+    "inserted_at": pa.timestamp("us", tz="UTC"),
+    "user_defined_id": pa.string(),
+    "pmid": pa.int64(),
+    "doi": pa.string(),
+    "filename": pa.string(),
+    "content_hash": pa.string(),
+    "user_comment": pa.string(),
+    "osm_version": pa.string(),
+}
+
+
+def get_invocation_collection():
     client = MongoClient(os.environ["MONGODB_URI"])
     engine = SyncEngine(client=client, database="osm")
-    matches = (
-        engine.get_collection(schemas.Invocation).aggregate(aggregation).__iter__()
-    )
+    return engine.get_collection(schemas.Invocation)
+
+
+def get_data_from_mongo(aggregation: list[dict] | None = None) -> Iterator[dict]:
+    if aggregation is None:
+        aggregation = DASHBOARD_AGGREGATION
+    matches = get_invocation_collection().aggregate(aggregation).__iter__()
     for match in matches:
         yield flatten_dict(match)
 
 
+def get_export_schema(aggregation: list[dict]) -> pa.Schema:
+    """
+    The schema of the flattened documents returned by the aggregation, derived
+    from the fields of its final $project stage.
+    """
+    projection = [stage["$project"] for stage in aggregation if "$project" in stage][-1]
+    metrics_schema = get_pyarrow_schema()
+    fields = []
+    for path, included in projection.items():
+        name = path.split(".")[-1]
+        if not included or name == "_id":
+            continue
+        if name in metrics_schema.names and name not in INVOCATION_FIELD_TYPES:
+            fields.append(metrics_schema.field(name))
+        else:
+            fields.append(pa.field(name, INVOCATION_FIELD_TYPES.get(name, pa.string())))
+    return pa.schema(fields)
+
+
+def _to_timestamp(value):
+    # Documents from bulk uploads store created_at as an ISO formatted string
+    if isinstance(value, str):
+        return datetime.datetime.fromisoformat(value)
+    if isinstance(value, datetime.datetime) and value.tzinfo is None:
+        # pymongo returns naive datetimes in UTC
+        return value.replace(tzinfo=datetime.UTC)
+    return value
+
+
+ARROW_ERRORS = (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError)
+
+
+def _to_array(values: list, data_type: pa.DataType) -> pa.Array:
+    if pa.types.is_integer(data_type):
+        # pa.array truncates floats given an integer type, a safe cast raises
+        return pa.array(values, from_pandas=True).cast(data_type)
+    try:
+        return pa.array(values, type=data_type, from_pandas=True)
+    except ARROW_ERRORS:
+        # e.g. booleans stored as strings in older documents
+        return pa.array(values, from_pandas=True).cast(data_type)
+
+
+def _to_record_batch(rows: list[dict], schema: pa.Schema) -> pa.RecordBatch:
+    columns = []
+    for field in schema:
+        values = [row.get(field.name) for row in rows]
+        if pa.types.is_timestamp(field.type):
+            values = [_to_timestamp(v) for v in values]
+        elif pa.types.is_list(field.type):
+            # A string would otherwise become a list of its characters
+            values = [[v] if isinstance(v, str) else v for v in values]
+        try:
+            columns.append(_to_array(values, field.type))
+        except ARROW_ERRORS:
+            # Convert value by value so only those that do not fit are lost
+            arrays = []
+            for value in values:
+                try:
+                    arrays.append(_to_array([value], field.type))
+                except ARROW_ERRORS:
+                    logger.warning(
+                        f"Exporting {field.name}={value!r} as null, "
+                        f"it cannot be converted to {field.type}"
+                    )
+                    arrays.append(pa.nulls(1, field.type))
+            columns.append(pa.concat_arrays(arrays))
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def export_invocations(
+    path: str | os.PathLike,
+    aggregation: list[dict] | None = None,
+    batch_size: int = 10_000,
+    collection=None,
+) -> int:
+    """
+    Stream the invocations matched by the aggregation to a Parquet file.
+
+    Documents are flattened and converted to record batches of a fixed
+    schema, then written as they arrive, so memory use is bounded by the
+    batch size rather than the size of the collection.
+
+    Returns:
+    - int: The number of rows written.
+    """
+    aggregation = aggregation or DASHBOARD_AGGREGATION
+    collection = collection if collection is not None else get_invocation_collection()
+    schema = get_export_schema(aggregation)
+    cursor = collection.aggregate(aggregation, batchSize=batch_size)
+    rows = 0
+    with pq.ParquetWriter(path, schema, compression="snappy") as writer:
+        while batch := [
+            flatten_dict(match) for match in itertools.islice(cursor, batch_size)
+        ]:
+            writer.write_batch(_to_record_batch(batch, schema))
+            rows += len(batch)
+    logger.info(f"Exported {rows} invocations to {path}")
+    return rows
+
+
+# State of a snapshot directory. Files starting with an underscore are
+# ignored by pyarrow when the directory is read as a dataset.
+SNAPSHOT_STATE = "_snapshot.json"
+
+
+def _snapshot_fragments(snapshot_dir: Path) -> list[Path]:
+    # Fragment names start with their creation time so they sort in order
+    return sorted(snapshot_dir.glob("part-*.parquet"))
+
+
+def _new_fragment_path(snapshot_dir: Path) -> Path:
+    now = datetime.datetime.now(datetime.UTC)
+    return snapshot_dir / f"part-{now:%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:8]}.parquet"
+
+
+def _write_atomically(path: Path, batches: Iterator[pa.RecordBatch], schema) -> int:
+    # Write under an ignored name so readers never see a partial fragment
+    tmp_path = path.with_name(f"_{path.name}")
+    rows = 0
+    try:
+        with pq.ParquetWriter(tmp_path, schema, compression="snappy") as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+                rows += batch.num_rows
+        if rows:
+            tmp_path.rename(path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return rows
+
+
+def _with_inserted_at(aggregation: list[dict]) -> list[dict]:
+    # The watermark is read from the exported rows so project it too
+    *stages, project = aggregation
+    return [*stages, {"$project": {**project["$project"], "inserted_at": True}}]
+
+
+def update_snapshot(
+    snapshot_dir: str | os.PathLike,
+    aggregation: list[dict] | None = None,
+    lag: datetime.timedelta = datetime.timedelta(minutes=10),
+    compact_after: int = 32,
+    batch_size: int = 10_000,
+    collection=None,
+) -> int:
+    """
+    Append the invocations stored since the last update to a snapshot.
+
+    A snapshot is a directory of Parquet fragments that can be read as one
+    dataset. The watermark is the latest inserted_at exported, which is set
+    when an invocation is stored, unlike created_at which is set by the
+    client and can be much older, e.g. for invocations queued in an outbox.
+    Each update fetches only the invocations inserted after the watermark,
+    less the lag, and writes them to a new fragment. The lag covers writes
+    still in flight; invocations already in the snapshot with the same
+    inserted_at are skipped. An invocation stored again, e.g. replaced on
+    upload, has a later inserted_at so the snapshot is compacted to drop the
+    older copy. Once there are more than compact_after fragments they are
+    merged into one.
+
+    Args:
+    - snapshot_dir (str | os.PathLike): The snapshot directory, created if needed.
+    - aggregation (list[dict]): Defaults to DASHBOARD_AGGREGATION.
+    - lag (datetime.timedelta): How far before the watermark to look for
+      invocations whose insert had not completed at the last update.
+    - compact_after (int): The number of fragments that triggers compaction.
+    - batch_size (int): Documents converted and written at a time.
+    - collection: The invocation collection, by default from MONGODB_URI.
+
+    Returns:
+    - int: The number of rows appended.
+    """
+    snapshot_dir = Path(snapshot_dir)
+    snapshot_dir.mkdir(parents=True, exist_ok=True)
+    state_path = snapshot_dir / SNAPSHOT_STATE
+    state = json.loads(state_path.read_text()) if state_path.exists() else {}
+    aggregation = _with_inserted_at(aggregation or DASHBOARD_AGGREGATION)
+    collection = collection if collection is not None else get_invocation_collection()
+    schema = get_export_schema(aggregation).append(
+        pa.field("invocation_id", pa.string())
+    )
+    started = datetime.datetime.now(datetime.UTC)
+
+    seen = set()
+    fragments = _snapshot_fragments(snapshot_dir)
+    if state.get("watermark"):
+        watermark = datetime.datetime.fromisoformat(state["watermark"])
+        since = watermark - lag
+        aggregation = [{"$match": {"inserted_at": {"$gte": since}}}, *aggregation]
+        if fragments:
+            recent = ds.dataset(fragments, format="parquet").to_table(
+                columns=["invocation_id", "inserted_at"],
+                filter=pc.field("inserted_at")
+                >= pa.scalar(since, schema.field("inserted_at").type),
+            )
+            seen = set(
+                zip(
+                    recent["invocation_id"].to_pylist(),
+                    recent["inserted_at"].to_pylist(),
+                )
+            )
+    else:
+        watermark = None
+
+    cursor = collection.aggregate(aggregation, batchSize=batch_size)
+    appended = set()
+
+    def batches() -> Iterator[pa.RecordBatch]:
+        nonlocal watermark
+        while matches := list(itertools.islice(cursor, batch_size)):
+            rows = []
+            for match in matches:
+                row = flatten_dict(match)
+                row["invocation_id"] = str(row.pop("_id", None))
+                rows.append(row)
+            batch = _to_record_batch(rows, schema)
+            # Compared after conversion so inserted_at matches the snapshot
+            batch = batch.filter(
+                [
+                    copy not in seen
+                    for copy in zip(
+                        batch["invocation_id"].to_pylist(),
+                        batch["inserted_at"].to_pylist(),
+                    )
+                ]
+            )
+            if not batch.num_rows:
+                continue
+            appended.update(batch["invocation_id"].to_pylist())
+            latest = pc.max(batch["inserted_at"]).as_py()
+            if latest is not None and (watermark is None or latest > watermark):
+                watermark = latest
+            yield batch
+
+    path = _new_fragment_path(snapshot_dir)
+    rows = _write_atomically(path, batches(), schema)
+    # Written after the fragment, so a crash in between is undone by the lag.
+    # Invocations stored before inserted_at was recorded are all in the first
+    # export, so without a later one the start of the update is used.
+    state["watermark"] = (watermark or started).isoformat()
+    tmp_state = state_path.with_name(f"{state_path.name}.tmp")
+    tmp_state.write_text(json.dumps(state))
+    tmp_state.replace(state_path)
+    logger.info(f"Appended {rows} invocations to {snapshot_dir}")
+
+    # Fragments from before this update holding an older copy of an invocation
+    replaced = (
+        fragments
+        and appended
+        and ds.dataset(fragments, format="parquet").count_rows(
+            filter=pc.field("invocation_id").isin(list(appended))
+        )
+    )
+    if replaced or len(_snapshot_fragments(snapshot_dir)) > compact_after:
+        compact_snapshot(snapshot_dir)
+    return rows
+
+
+def _latest_copies(dataset: ds.Dataset) -> dict:
+    # The latest inserted_at of each invocation stored more than once
+    table = dataset.to_table(columns=["invocation_id", "inserted_at"])
+    counts = pc.value_counts(table["invocation_id"])
+    duplicated = pc.filter(
+        counts.field("values"), pc.greater(counts.field("counts"), 1)
+    )
+    if not len(duplicated):
+        return {}
+    latest = (
+        table.filter(pc.is_in(table["invocation_id"], duplicated))
+        .group_by("invocation_id")
+        .aggregate([("inserted_at", "max")])
+    )
+    return dict(
+        zip(
+            latest["invocation_id"].to_pylist(),
+            latest["inserted_at_max"].to_pylist(),
+        )
+    )
+
+
+def compact_snapshot(snapshot_dir: str | os.PathLike):
+    """
+    Merge the fragments of a snapshot into a single Parquet file.
+
+    Only the copy with the latest inserted_at is kept for an invocation stored
+    more than once.
+    """
+    snapshot_dir = Path(snapshot_dir)
+    fragments = _snapshot_fragments(snapshot_dir)
+    if len(fragments) < 2:
+        return
+    dataset = ds.dataset(fragments, format="parquet")
+    latest = _latest_copies(dataset)
+
+    def batches() -> Iterator[pa.RecordBatch]:
+        kept = set()
+        for batch in dataset.to_batches():
+            if latest:
+                keep = []
+                for invocation_id, inserted_at in zip(
+                    batch["invocation_id"].to_pylist(),
+                    batch["inserted_at"].to_pylist(),
+                ):
+                    if invocation_id not in latest:
+                        keep.append(True)
+                    elif (
+                        inserted_at == latest[invocation_id]
+                        and invocation_id not in kept
+                    ):
+                        kept.add(invocation_id)
+                        keep.append(True)
+                    else:
+                        keep.append(False)
+                batch = batch.filter(keep)
+            yield batch
+
+    _write_atomically(_new_fragment_path(snapshot_dir), batches(), dataset.schema)
+    for fragment in fragments:
+        fragment.unlink()
+    logger.info(f"Compacted {len(fragments)} fragments in {snapshot_dir}")
+
+
 def infer_type_for_column(column):
     # Check if the entire column contains lists
     if column.apply(lambda x: isinstance(x, list)).all():
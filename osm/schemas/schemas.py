@@ -82,6 +82,8 @@ class Invocation(Model):
     created_at: datetime.datetime = Field(
         default_factory=lambda: datetime.datetime.now(datetime.UTC)
     )
+    # Set when the invocation is stored, by the server rather than the client
+    inserted_at: Optional[datetime.datetime] = None
 
 
 class Quarantine(Model):
@@ -1,11 +1,23 @@
 import argparse
+import datetime
+import hashlib
+import json
 import logging
 import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 
+import pyarrow as pa
 import pyarrow.dataset as ds
 import pymongo
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
 
+from osm.pipeline.batch import Stage, StagedExecutor
 from osm.schemas import Component, schema_helpers
 from osm.schemas.schema_helpers import transform_data
 
@@ -55,16 +67,194 @@ def parse_args():
         "--custom-processing",
         help="Name of function that applies custom processing to the data",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Processes converting rows to invocations. Default is the number of cpus.",
+    )
+    parser.add_argument(
+        "--insert-workers",
+        type=int,
+        default=4,
+        help="Concurrent bulk inserts into the database. Default is 4.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=5000,
+        help="""Rows read, converted and inserted at a time. Together with the
+        worker counts this bounds the memory used. Default is 5000.""",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=Path,
+        help="""File recording the uploaded chunks so that a failed upload can
+        be resumed by running the same command again. Default is a file in the
+        current directory named after the input and tags.""",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Ignore the manifest of a previous run and process every chunk.",
+    )
+    parser.add_argument(
+        "--on-conflict",
+        choices=["skip", "replace"],
+        default="skip",
+        help="""What to do with rows that are already in the database, as
+        identified by their data tags and pmid or doi. Default is 'skip'.""",
+    )
     return parser.parse_args()
 
 
-def get_data(args):
+DUPLICATE_KEY_ERROR = 11000
+
+
+@dataclass
+class Chunk:
+    """A batch of rows read from a fragment (file) of the dataset."""
+
+    fragment: str
+    index: int
+    rows: pa.RecordBatch
+
+    def __str__(self) -> str:
+        return f"{self.fragment} chunk {self.index}"
+
+
+class Manifest:
+    """The chunks uploaded so far, saved after each chunk to allow resuming."""
+
+    def __init__(self, path: Path, input_file: str, batch_size: int):
+        self.path = path
+        # Chunk boundaries depend on the batch size
+        self.source = {
+            "input_file": str(Path(input_file).resolve()),
+            "batch_size": batch_size,
+        }
+        self.completed: dict[str, set[int]] = {}
+        self._lock = threading.Lock()
+        if path.exists():
+            manifest = json.loads(path.read_text())
+            if manifest["source"] == self.source:
+                self.completed = {
+                    fragment: set(indices)
+                    for fragment, indices in manifest["completed"].items()
+                }
+            else:
+                logger.warning(f"Ignoring {path}, it is for a different upload")
+
+    def __len__(self) -> int:
+        return sum(len(indices) for indices in self.completed.values())
+
+    def is_complete(self, chunk: Chunk) -> bool:
+        return chunk.index in self.completed.get(chunk.fragment, ())
+
+    def complete(self, chunk: Chunk):
+        with self._lock:
+            self.completed.setdefault(chunk.fragment, set()).add(chunk.index)
+            manifest = {
+                "source": self.source,
+                "completed": {
+                    fragment: sorted(indices)
+                    for fragment, indices in self.completed.items()
+                },
+            }
+            # Replace the file in one step so that it is never left partial
+            with tempfile.NamedTemporaryFile(
+                "w", dir=self.path.parent, suffix=".tmp", delete=False
+            ) as tmp_file:
+                json.dump(manifest, tmp_file)
+            os.replace(tmp_file.name, self.path)
+
+
+def get_manifest_path(args) -> Path:
+    upload = f"{Path(args.input_file).resolve()}:{args.custom_processing}:{args.tags}"
+    return Path(
+        f"invocation_upload-{hashlib.sha256(upload.encode()).hexdigest()[:12]}.json"
+    )
+
+
+def get_data(args) -> ds.Dataset:
     file_in = Path(args.input_file)
     if file_in.is_dir() or file_in.suffix == ".parquet":
-        tb = ds.dataset(file_in, format="parquet").to_table()
-    else:
-        raise ValueError("Only parquet files are supported")
-    return tb
+        return ds.dataset(file_in, format="parquet")
+    raise ValueError("Only parquet files are supported")
+
+
+def fragment_name(path: str, root: str) -> str:
+    """Name a fragment by its path within the dataset, or its file name when
+    the dataset is a single file, so that the name does not depend on the
+    working directory or how the input was given."""
+    path, root = Path(path).resolve(), Path(root).resolve()
+    if path == root:
+        return path.name
+    return path.relative_to(root).as_posix()
+
+
+def read_chunks(dataset: ds.Dataset, batch_size: int, manifest: Manifest, root: str):
+    """Stream the dataset fragment by fragment, skipping uploaded chunks."""
+    skipped = 0
+    for fragment in dataset.get_fragments():
+        name = fragment_name(fragment.path, root)
+        # Read in order so that chunks are the same from one run to the next
+        batches = fragment.to_batches(batch_size=batch_size, use_threads=False)
+        for index, batch in enumerate(batches):
+            chunk = Chunk(name, index, batch)
+            if manifest.is_complete(chunk):
+                skipped += 1
+            elif batch.num_rows:
+                yield chunk
+    if skipped:
+        logger.info(f"Skipped {skipped} chunks uploaded by a previous run")
+
+
+def row_key(invocation: dict, source: str, chunk: Chunk, offset: int) -> str:
+    """Identify a row by its data source and the work it describes."""
+    work = invocation["work"]
+    if work["pmid"] is not None:
+        return f"{source}:pmid:{work['pmid']}"
+    if work["doi"]:
+        return f"{source}:doi:{work['doi']}"
+    return f"{source}:{chunk.fragment}:{chunk.index}:{offset}"
+
+
+def transform_chunk(chunk: Chunk, upload_kwargs: dict) -> list[dict]:
+    invocations = list(
+        transform_data(pa.Table.from_batches([chunk.rows]), **upload_kwargs)
+    )
+    source = ",".join(sorted(upload_kwargs.get("data_tags") or []))
+    for offset, invocation in enumerate(invocations):
+        # A deterministic id makes repeated uploads of a row idempotent
+        key = row_key(invocation, source, chunk, offset)
+        invocation["_id"] = ObjectId(hashlib.sha256(key.encode()).digest()[:12])
+    return invocations
+
+
+def insert_invocations(collection, invocations: list[dict], on_conflict: str) -> int:
+    """Insert the invocations and return how many were already present."""
+    # Dashboard snapshots fetch the invocations inserted since their last update
+    inserted_at = datetime.datetime.now(datetime.UTC)
+    for invocation in invocations:
+        invocation["inserted_at"] = inserted_at
+    if on_conflict == "replace":
+        result = collection.bulk_write(
+            [
+                pymongo.ReplaceOne({"_id": doc["_id"]}, doc, upsert=True)
+                for doc in invocations
+            ],
+            ordered=False,
+        )
+        return result.matched_count
+    try:
+        collection.insert_many(invocations, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details["writeErrors"]
+        if any(error["code"] != DUPLICATE_KEY_ERROR for error in errors):
+            raise
+        return len(errors)
+    return 0
 
 
 def get_upload_kwargs(args):
@@ -91,14 +281,74 @@ def get_upload_kwargs(args):
     return kwargs
 
 
+def upload(dataset: ds.Dataset, collection, upload_kwargs: dict, args):
+    """
+    Convert and insert the dataset in chunks. Chunks are converted by a pool
+    of processes and inserted by several threads at once, with bounded queues
+    between the stages so that only a few chunks are held in memory at a time.
+    Each inserted chunk is recorded in the manifest and rows have
+    deterministic ids, so rerunning after a failure only uploads what is
+    missing.
+    """
+    manifest_path = args.manifest or get_manifest_path(args)
+    manifest = Manifest(manifest_path, args.input_file, args.batch_size)
+    if args.restart:
+        manifest.completed = {}
+    inserted = 0
+    existing = 0
+    lock = threading.Lock()
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+
+        def transform(chunk: Chunk) -> tuple[Chunk, list[dict]]:
+            rows = pool.submit(transform_chunk, chunk, upload_kwargs).result()
+            # The rows are no longer needed once converted
+            return Chunk(chunk.fragment, chunk.index, None), rows
+
+        def insert(transformed: tuple[Chunk, list[dict]]):
+            nonlocal inserted, existing
+            chunk, invocations = transformed
+            present = 0
+            if invocations:
+                present = insert_invocations(collection, invocations, args.on_conflict)
+            manifest.complete(chunk)
+            with lock:
+                inserted += len(invocations) - present
+                existing += present
+
+        executor = StagedExecutor(
+            [
+                Stage("transform", transform, args.workers),
+                Stage("insert", insert, args.insert_workers),
+            ],
+            queue_size=args.workers,
+        )
+        start = time.monotonic()
+        summary = executor.run(
+            read_chunks(dataset, args.batch_size, manifest, args.input_file)
+        )
+    elapsed = time.monotonic() - start
+    logger.info(
+        f"Inserted {inserted} invocations from {summary.processed} chunks in "
+        f"{elapsed:.1f}s ({inserted / elapsed if elapsed else 0:.0f} rows/s). "
+        f"{existing} were already present ({args.on_conflict})."
+    )
+    if summary.failed:
+        raise RuntimeError(
+            f"{len(summary.failed)} chunks failed, rerun to retry them: "
+            + ", ".join(str(chunk) for chunk, _ in summary.failed)
+        )
+    logger.info(f"Progress was recorded in {manifest_path}")
+
+
 def main():
     args = parse_args()
-    tb = get_data(args)
+    dataset = get_data(args)
     upload_kwargs = get_upload_kwargs(args)
 
     try:
         db = pymongo.MongoClient(MONGODB_URI).osm
-        db.invocation.insert_many(transform_data(tb, **upload_kwargs), ordered=False)
+        upload(dataset, db.invocation, upload_kwargs, args)
     except Exception as e:
         logger.error(f"Failed to process data: {e}")
         raise e
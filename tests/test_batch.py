@@ -0,0 +1,99 @@
+import threading
+import time
+
+import pytest
+
+from osm._utils import _discover_documents
+from osm.pipeline.batch import BatchPipeline, Document, Stage, StagedExecutor
+
+
+class FakePipeline:
+    def __init__(self, document, seen, lock):
+        self.document = document
+        self.seen = seen
+        self.lock = lock
+
+    def parse(self, user_managed_compose=False):
+        return [self.document.uid]
+
+    def extract(self, parsed):
+        if parsed == ["bad"]:
+            raise ValueError("cannot extract")
+        return [{"uid": uid} for uid in parsed]
+
+    def save(self, extracted):
+        with self.lock:
+            self.seen.extend(metrics["uid"] for metrics in extracted)
+
+
+def make_document(tmp_path, uid):
+    return Document(
+        input_path=tmp_path / f"{uid}.pdf",
+        uid=uid,
+        xml_path=tmp_path / f"{uid}.xml",
+        metrics_path=tmp_path / f"{uid}.json",
+    )
+
+
+def test_batch_pipeline_continues_after_failures(tmp_path):
+    seen, lock = [], threading.Lock()
+    documents = [make_document(tmp_path, uid) for uid in ["a", "bad", "b", "c"]]
+    batch = BatchPipeline(
+        documents=iter(documents),
+        pipeline_factory=lambda document: FakePipeline(document, seen, lock),
+        workers=2,
+    )
+    summary = batch.run()
+
+    assert sorted(seen) == ["a", "b", "c"]
+    assert summary.processed == 3
+    assert [document.uid for document, _ in summary.failed] == ["bad"]
+
+
+def test_staged_executor_bounds_queues(tmp_path):
+    in_flight, peak, lock = [0], [0], threading.Lock()
+
+    def start(document):
+        with lock:
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+        return document.uid
+
+    def finish(uid):
+        time.sleep(0.001)
+        with lock:
+            in_flight[0] -= 1
+
+    documents = (make_document(tmp_path, str(i)) for i in range(50))
+    executor = StagedExecutor(
+        [Stage("start", start, 1), Stage("finish", finish, 1)], queue_size=2
+    )
+    summary = executor.run(documents)
+
+    assert summary.processed == 50
+    # one item in each worker plus the queue between the stages
+    assert peak[0] <= 4
+
+
+def test_discover_documents(tmp_path):
+    (tmp_path / "nested").mkdir()
+    for name in ["one.pdf", "nested/two.xml", "notes.txt"]:
+        (tmp_path / name).write_bytes(b"")
+
+    from_dir = _discover_documents(str(tmp_path))
+    assert sorted(uid for _, uid in from_dir) == ["one", "two"]
+
+    from_glob = _discover_documents(str(tmp_path / "*.pdf"))
+    assert [uid for _, uid in from_glob] == ["one"]
+
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text(f"filepath,uid\n{tmp_path / 'one.pdf'},10.1000/xyz\n")
+    assert _discover_documents(str(manifest)) == [(tmp_path / "one.pdf", "10.1000/xyz")]
+
+
+def test_discover_documents_rejects_duplicate_uids(tmp_path):
+    (tmp_path / "nested").mkdir()
+    for name in ["one.pdf", "nested/one.pdf"]:
+        (tmp_path / name).write_bytes(b"")
+    with pytest.raises(ValueError):
+        _discover_documents(str(tmp_path))
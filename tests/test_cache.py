@@ -0,0 +1,90 @@
+import pytest
+
+from osm.pipeline.cache import MetricsCache, ParsedCache
+from osm.pipeline.core import Component, Pipeline
+
+
+class CountingParser(Component):
+    cacheable = True
+
+    def __init__(self, version="0.0.1"):
+        super().__init__(version=version)
+        self.calls = 0
+
+    def _run(self, data: bytes, user_managed_compose=False) -> bytes:
+        self.calls += 1
+        return b"<xml>" + data + b"</xml>"
+
+
+@pytest.fixture
+def sample_pdf(tmp_path):
+    pdf_path = tmp_path / "test_sample.pdf"
+    pdf_path.write_bytes(b"%PDF-1.4\n%Test PDF content\n")
+    return pdf_path
+
+
+def make_pipeline(input_path, parser, cache):
+    return Pipeline(
+        input_path=input_path,
+        parsers=[parser],
+        extractors=[],
+        savers=None,
+        parsed_cache=cache,
+    )
+
+
+def test_parsed_cache_reuses_output(tmp_path, sample_pdf):
+    cache = ParsedCache(tmp_path / "cache")
+    first, second = CountingParser(), CountingParser()
+
+    expected = (b"<xml>" + sample_pdf.read_bytes() + b"</xml>", False)
+    assert make_pipeline(sample_pdf, first, cache)._run_parser(first, True) == expected
+    assert (
+        make_pipeline(sample_pdf, second, cache)._run_parser(second, True) == expected
+    )
+    assert (first.calls, second.calls) == (1, 0)
+
+
+def test_parsed_cache_is_keyed_by_version(tmp_path, sample_pdf):
+    cache = ParsedCache(tmp_path / "cache")
+    old, new = CountingParser("0.0.1"), CountingParser("0.0.2")
+
+    make_pipeline(sample_pdf, old, cache)._run_parser(old, True)
+    make_pipeline(sample_pdf, new, cache)._run_parser(new, True)
+    assert (old.calls, new.calls) == (1, 1)
+
+
+class Extractor(Component):
+    cacheable = True
+
+    def _run(self, data: bytes, parser: str = None) -> dict:
+        return {}
+
+
+def test_metrics_cache_roundtrip(tmp_path):
+    cache = MetricsCache(tmp_path)
+    extractor = Extractor()
+
+    assert cache.get("abc", extractor, "ScienceBeamParser") is None
+    cache.put("abc", extractor, "ScienceBeamParser", {"is_open_data": True})
+    assert cache.get("abc", extractor, "ScienceBeamParser") == {"is_open_data": True}
+    # the parser and the extractor version are part of the key
+    assert cache.get("abc", extractor, "PMCParser") is None
+    assert cache.get("abc", Extractor(version="0.0.2"), "ScienceBeamParser") is None
+    # entries persist across instances
+    assert MetricsCache(tmp_path).get("abc", extractor, "ScienceBeamParser")
+
+
+def test_metrics_cache_evicts_least_recently_used(tmp_path):
+    metrics = {"title": "x" * 100}
+    cache = MetricsCache(tmp_path, max_bytes=250)
+    extractor = Extractor()
+
+    cache.put("first", extractor, "parser", metrics)
+    cache.put("second", extractor, "parser", metrics)
+    cache.get("first", extractor, "parser")
+    cache.put("third", extractor, "parser", metrics)
+
+    assert cache.get("first", extractor, "parser") == metrics
+    assert cache.get("second", extractor, "parser") is None
+    assert cache.get("third", extractor, "parser") == metrics
@@ -0,0 +1,42 @@
+from types import SimpleNamespace
+
+import pyarrow as pa
+
+from osm.pipeline.extractors import RTransparentExtractor, read_metrics_table
+
+
+def to_ipc(table: pa.Table) -> bytes:
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def test_read_metrics_table_casts_to_schema():
+    table = pa.table(
+        {
+            "pmid": [1, None],
+            "is_open_data": [None, None],
+            "funding_text": ["NIH", None],
+            "error": [None, "bad xml"],
+        }
+    )
+    result = read_metrics_table(to_ipc(table))
+    assert result.schema.field("pmid").type == pa.int64()
+    assert result.schema.field("is_open_data").type == pa.bool_()
+    assert result.column("error").to_pylist() == [None, "bad xml"]
+    assert result.to_pylist()[1]["funding_text"] is None
+
+
+def test_extractor_requests_arrow_responses():
+    class Session:
+        def post(self, url, files, params):
+            self.params = params
+            table = pa.table({"pmid": [1], "is_open_data": [None]})
+            return SimpleNamespace(status_code=200, content=to_ipc(table))
+
+    session = Session()
+    extractor = RTransparentExtractor(session=session, response_format="arrow")
+    metrics = extractor._run(b"<article/>", parser="NoopParser")
+    assert session.params == {"parser": "NoopParser", "format": "arrow"}
+    assert metrics == {"is_open_data": None}
@@ -1,5 +1,11 @@
+import hashlib
+from pathlib import Path
+
 import pytest
 
+from osm.pipeline.core import Component, Pipeline, Savers
+from osm.pipeline.parsers import NoopParser, ScienceBeamParser
+
 
 @pytest.fixture
 def sample_pdf(tmp_path):
@@ -7,3 +13,89 @@ def sample_pdf(tmp_path):
     pdf_path.write_bytes(b"%PDF-1.4\n%Test PDF content\n")
     yield pdf_path
     pdf_path.unlink()
+
+
+class StreamingParser(Component):
+    streams_input = True
+
+    def _run(self, data, user_managed_compose=False, output_path=None):
+        assert isinstance(data, Path)
+        with data.open("rb") as pdf, output_path.open("wb") as xml:
+            xml.write(b"<xml>" + pdf.read() + b"</xml>")
+        return output_path
+
+
+class RecordingSaver(Component):
+    def __init__(self):
+        super().__init__()
+        self.saved = []
+
+    def _run(self, data, **kwargs):
+        self.saved.append(data)
+
+
+def test_streaming_parser_writes_output_directly(tmp_path, sample_pdf):
+    file_saver = RecordingSaver()
+    pipeline = Pipeline(
+        input_path=sample_pdf,
+        xml_path=tmp_path / "output.xml",
+        parsers=[StreamingParser()],
+        extractors=[],
+        savers=Savers(file_saver, RecordingSaver(), RecordingSaver()),
+    )
+    [(_, parsed)] = pipeline.parse()
+    assert parsed == (tmp_path / "output.xml").read_bytes()
+    assert parsed.startswith(b"<xml>%PDF")
+    assert pipeline._file_data is None
+    assert file_saver.saved == []
+
+
+class BrokenStream:
+    """A TEI response whose connection drops after the first chunk."""
+
+    status_code = 200
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield b"<TEI>"
+        raise ConnectionError("Connection reset")
+
+
+class BrokenStreamSession:
+    def post(self, url, **kwargs):
+        return BrokenStream()
+
+
+def test_sciencebeam_leaves_no_truncated_output(tmp_path, sample_pdf):
+    parser = ScienceBeamParser(session=BrokenStreamSession())
+    output_path = tmp_path / "output.xml"
+    with pytest.raises(ConnectionError):
+        parser.run(sample_pdf, user_managed_compose=True, output_path=output_path)
+    assert list(tmp_path.iterdir()) == [sample_pdf]
+
+
+def test_file_data_is_memory_mapped(tmp_path, sample_pdf):
+    file_saver = RecordingSaver()
+    pipeline = Pipeline(
+        input_path=sample_pdf,
+        xml_path=tmp_path / "output.xml",
+        parsers=[NoopParser()],
+        extractors=[],
+        savers=Savers(file_saver, RecordingSaver(), RecordingSaver()),
+    )
+    assert isinstance(pipeline.file_data, memoryview)
+    assert pipeline.content_hash == hashlib.sha256(sample_pdf.read_bytes()).hexdigest()
+    pipeline.parse()
+    assert file_saver.saved == [pipeline.file_data]
+    assert bytes(file_saver.saved[0]) == sample_pdf.read_bytes()
+
+
+def test_empty_file_data(tmp_path):
+    empty = tmp_path / "empty.xml"
+    empty.touch()
+    assert Pipeline.map_file(empty) == b""
@@ -0,0 +1,47 @@
+from types import SimpleNamespace
+
+import requests
+
+from osm import _http
+from osm._http import make_session
+
+
+def test_only_idempotent_requests_are_retried():
+    session = make_session()
+    upload = session.get_adapter("http://localhost:80/upload/").max_retries
+    assert not upload.is_retry("PUT", 503)
+    assert upload.is_retry("GET", 503)
+    extraction = session.get_adapter(
+        "http://localhost:8071/extract-metrics/"
+    ).max_retries
+    assert extraction.is_retry("POST", 503)
+
+
+def test_probe_requires_a_successful_health_check(monkeypatch):
+    monkeypatch.setattr(_http, "_ready_services", set())
+    status = 404
+    monkeypatch.setattr(
+        requests.Session,
+        "get",
+        lambda self, url, **kwargs: SimpleNamespace(status_code=status),
+    )
+    assert not _http.probe_service("rtransparent")
+    status = 200
+    assert _http.probe_service("rtransparent")
+
+
+def test_probe_without_health_endpoint_needs_an_http_response(monkeypatch):
+    monkeypatch.setattr(_http, "_ready_services", set())
+
+    def reset(self, url, **kwargs):
+        # What a forwarded port without the service behind it does
+        raise requests.exceptions.ConnectionError("Connection reset by peer")
+
+    monkeypatch.setattr(requests.Session, "get", reset)
+    assert not _http.probe_service("sciencebeam")
+    monkeypatch.setattr(
+        requests.Session,
+        "get",
+        lambda self, url, **kwargs: SimpleNamespace(status_code=404),
+    )
+    assert _http.probe_service("sciencebeam")
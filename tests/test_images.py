@@ -0,0 +1,65 @@
+import datetime
+import json
+from types import SimpleNamespace
+
+from osm._utils import _get_cache_dir, _refresh_images
+
+
+class FakeDocker:
+    def __init__(self, local, unreachable=()):
+        self.local = set(local)
+        self.unreachable = set(unreachable)
+        self.pulled = []
+        services = {
+            image: SimpleNamespace(image=image)
+            for image in ("fresh", "missing", "stale", "offline")
+        }
+        self.compose = SimpleNamespace(
+            config=lambda: SimpleNamespace(services=services)
+        )
+        self.image = SimpleNamespace(
+            exists=lambda image: image in self.local,
+            pull=self.pull,
+            inspect=lambda image: SimpleNamespace(
+                id=f"sha256:{image}", repo_digests=[f"{image}@sha256:1"]
+            ),
+        )
+
+    def pull(self, image, quiet=False):
+        self.pulled.append(image)
+        if image in self.unreachable:
+            raise RuntimeError("registry unreachable")
+        self.local.add(image)
+
+
+def test_refresh_images_pulls_missing_and_stale_images(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    state_path = _get_cache_dir() / "images.json"
+    now = datetime.datetime.now(datetime.UTC)
+    checked = {
+        "fresh": now - datetime.timedelta(hours=1),
+        "stale": now - datetime.timedelta(hours=48),
+        "offline": now - datetime.timedelta(hours=48),
+    }
+    state_path.write_text(
+        json.dumps(
+            {
+                image: {"id": "old", "repo_digests": [], "checked_at": at.isoformat()}
+                for image, at in checked.items()
+            }
+        )
+    )
+    docker = FakeDocker(local=checked, unreachable={"offline"})
+    _refresh_images(docker, datetime.timedelta(hours=24))
+    assert docker.pulled == ["missing", "offline", "stale"]
+
+    state = json.loads(state_path.read_text())
+    # Images that were pulled are recorded despite the failure
+    assert state["missing"]["id"] == "sha256:missing"
+    assert state["stale"]["id"] == "sha256:stale"
+    assert state["fresh"]["id"] == state["offline"]["id"] == "old"
+
+    # Only the image that could not be pulled is tried again
+    docker.pulled = []
+    _refresh_images(docker, datetime.timedelta(hours=24))
+    assert docker.pulled == ["offline"]
@@ -0,0 +1,115 @@
+import importlib.util
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from pymongo.errors import BulkWriteError
+
+from osm.schemas import Component
+
+SCRIPT = Path(__file__).parents[1] / "scripts" / "invocation_upload.py"
+
+
+@pytest.fixture
+def invocation_upload(monkeypatch):
+    monkeypatch.setenv("DB_NAME", "osm")
+    monkeypatch.setenv("MONGODB_URI", "mongodb://localhost:27017")
+    spec = importlib.util.spec_from_file_location("invocation_upload", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    # Registered so that the worker processes can unpickle transform_chunk
+    monkeypatch.setitem(sys.modules, "invocation_upload", module)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeCollection:
+    def __init__(self):
+        self.documents = {}
+
+    def insert_many(self, documents, ordered=True):
+        errors = []
+        for document in documents:
+            if document["_id"] in self.documents:
+                errors.append({"code": 11000})
+            else:
+                self.documents[document["_id"]] = document
+        if errors:
+            raise BulkWriteError({"writeErrors": errors})
+
+
+def make_args(tmp_path, input_file, restart=False):
+    return SimpleNamespace(
+        input_file=str(input_file),
+        manifest=tmp_path / "manifest.json",
+        batch_size=3,
+        workers=2,
+        insert_workers=2,
+        on_conflict="skip",
+        custom_processing=None,
+        tags=[],
+        restart=restart,
+    )
+
+
+def test_upload_is_chunked_and_idempotent(tmp_path, invocation_upload):
+    dataset_dir = tmp_path / "dataset"
+    dataset_dir.mkdir()
+    for part in range(2):
+        pq.write_table(
+            pa.table(
+                {
+                    "pmid": [part * 10 + i for i in range(5)],
+                    "is_open_code": [True, False, None, True, False],
+                    "is_open_data": [False] * 5,
+                    "year": [2020] * 5,
+                }
+            ),
+            dataset_dir / f"part-{part}.parquet",
+        )
+    upload_kwargs = {
+        "data_tags": ["test"],
+        "components": [Component(name="RTransparent", version="x.x.x")],
+    }
+    collection = FakeCollection()
+    args = make_args(tmp_path, dataset_dir)
+    dataset = invocation_upload.get_data(args)
+    invocation_upload.upload(dataset, collection, upload_kwargs, args)
+    assert sorted(doc["work"]["pmid"] for doc in collection.documents.values()) == [
+        *range(5),
+        *range(10, 15),
+    ]
+    # Each of the two fragments was read as two chunks
+    assert len(invocation_upload.Manifest(args.manifest, dataset_dir, 3)) == 4
+
+    # Uploading everything again adds nothing
+    args.restart = True
+    invocation_upload.upload(dataset, collection, upload_kwargs, args)
+    assert len(collection.documents) == 10
+
+
+def test_rows_without_ids_keep_their_keys_across_paths(
+    tmp_path, monkeypatch, invocation_upload
+):
+    dataset_dir = tmp_path / "dataset"
+    dataset_dir.mkdir()
+    pq.write_table(
+        pa.table({"is_open_code": [True, False], "is_open_data": [None, True]}),
+        dataset_dir / "part-0.parquet",
+    )
+    upload_kwargs = {"data_tags": ["test"], "components": []}
+    collection = FakeCollection()
+    args = make_args(tmp_path, dataset_dir)
+    invocation_upload.upload(
+        invocation_upload.get_data(args), collection, upload_kwargs, args
+    )
+
+    # The same dataset given as a relative path from another directory
+    monkeypatch.chdir(tmp_path)
+    args = make_args(tmp_path, "dataset", restart=True)
+    invocation_upload.upload(
+        invocation_upload.get_data(args), collection, upload_kwargs, args
+    )
+    assert len(collection.documents) == 2
@@ -0,0 +1,168 @@
+import json
+import os
+import subprocess
+import sys
+from types import SimpleNamespace
+
+import requests
+
+from osm.cli import close_savers
+from osm.pipeline.outbox import Outbox
+
+
+def make_invocation(content_hash, user_defined_id="uid"):
+    return {
+        "work": {"content_hash": content_hash, "user_defined_id": user_defined_id},
+        "client": {"compute_context_id": 1, "email": None},
+        "components": [{"name": "RTransparentExtractor", "version": "0.0.1"}],
+    }
+
+
+class FlakySession:
+    """Fails the first upload, then stores every invocation."""
+
+    def __init__(self):
+        self.uploads = []
+
+    def put(self, url, json=None, **kwargs):
+        if not self.uploads:
+            self.uploads.append(None)
+            raise ConnectionError("API unavailable")
+        self.uploads.append(json)
+        return FakeResponse(json)
+
+
+class FakeResponse:
+    def __init__(self, invocations, status_code=200):
+        self.invocations = invocations
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error", response=self)
+
+    def json(self):
+        return {
+            "results": [
+                {"index": i, "status": "inserted", "error": None}
+                for i in range(len(self.invocations))
+            ]
+        }
+
+
+def test_outbox_persists_and_retries(tmp_path, monkeypatch):
+    monkeypatch.setenv("OSM_API", "http://api")
+    session = FlakySession()
+    outbox = Outbox(tmp_path / "outbox.sqlite", batch_size=10, session=session)
+    outbox.add(make_invocation("a"))
+    outbox.add(make_invocation("b"))
+    # Adding the same invocation again is a no-op
+    outbox.add(make_invocation("a"))
+    assert len(outbox) == 2
+    # The same document submitted as a different work is a separate record
+    outbox.add(make_invocation("a", user_defined_id="other"))
+    assert len(outbox) == 3
+    outbox.close(timeout=5)
+
+    [uploaded] = [upload for upload in session.uploads if upload]
+    assert [i["work"]["content_hash"] for i in uploaded] == ["a", "b", "a"]
+    # Ids are derived from the content so retried uploads are duplicates
+    assert len({i["id"] for i in uploaded}) == 3
+    reopened = Outbox(tmp_path / "outbox.sqlite", session=session)
+    assert len(reopened) == 0
+    reopened.close(timeout=1)
+
+
+def test_cli_waits_for_the_outbox_drain_timeout(tmp_path, monkeypatch):
+    monkeypatch.setenv("OSM_API", "http://api")
+    outbox = Outbox(tmp_path / "outbox.sqlite", session=FlakySession())
+    timeouts = []
+    close = outbox.close
+    monkeypatch.setattr(
+        outbox, "close", lambda timeout: timeouts.append(timeout) or close(timeout)
+    )
+    close_savers(SimpleNamespace(outbox_drain_timeout=7), upload_buffer=outbox)
+    assert timeouts == [7]
+
+
+def test_outbox_limits_batch_bytes(tmp_path, monkeypatch):
+    monkeypatch.setenv("OSM_API", "http://api")
+    session = FlakySession()
+    session.uploads.append(None)  # Succeed from the first upload
+    invocation = make_invocation("a")
+    size = len(json.dumps({**invocation, "id": "0" * 24}))
+    outbox = Outbox(
+        tmp_path / "outbox.sqlite",
+        batch_size=10,
+        max_wait=60,
+        session=session,
+        max_batch_bytes=2 * size,
+    )
+    for content_hash in "abc":
+        outbox.add(make_invocation(content_hash))
+    outbox.close(timeout=5)
+    uploads = [upload for upload in session.uploads if upload]
+    assert [len(upload) for upload in uploads] == [2, 1]
+
+
+class RejectingSession:
+    """Rejects batches of several invocations and the invocation "b"."""
+
+    def __init__(self):
+        self.uploads = []
+        self.quarantined = []
+
+    def put(self, url, json=None, **kwargs):
+        if url.endswith("/quarantine/"):
+            self.quarantined.append(json)
+            return FakeResponse([])
+        if len(json) > 1:
+            return FakeResponse(json, status_code=413)
+        if json[0]["work"]["content_hash"] == "b":
+            return FakeResponse(json, status_code=422)
+        self.uploads.append(json)
+        return FakeResponse(json)
+
+
+def test_outbox_splits_and_quarantines_rejected_batches(tmp_path, monkeypatch):
+    monkeypatch.setenv("OSM_API", "http://api")
+    session = RejectingSession()
+    outbox = Outbox(tmp_path / "outbox.sqlite", batch_size=10, session=session)
+    for content_hash in "abc":
+        outbox.add(make_invocation(content_hash))
+    outbox.close(timeout=5)
+
+    uploaded = [i["work"]["content_hash"] for [i] in session.uploads]
+    assert uploaded == ["a", "c"]
+    [failure] = session.quarantined
+    assert "422" in failure["error_message"]
+    reopened = Outbox(tmp_path / "outbox.sqlite", session=session)
+    assert len(reopened) == 0
+    reopened.close(timeout=1)
+
+
+def test_idempotency_key_is_stable_across_processes():
+    script = """
+from osm._utils import get_compute_context_id
+from osm.pipeline.outbox import idempotency_key
+
+invocation = {
+    "work": {"content_hash": "a", "user_defined_id": "uid"},
+    "client": {"compute_context_id": get_compute_context_id(), "email": None},
+    "components": [{"name": "RTransparentExtractor", "version": "0.0.1"}],
+}
+print(idempotency_key(invocation))
+"""
+    # Each process salts hash() differently
+    env = {k: v for k, v in os.environ.items() if k != "PYTHONHASHSEED"}
+    keys = {
+        subprocess.run(
+            [sys.executable, "-c", script],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        for _ in range(2)
+    }
+    assert len(keys) == 1
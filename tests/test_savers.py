@@ -0,0 +1,213 @@
+import base64
+import json
+from types import SimpleNamespace
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pytest
+
+from osm.pipeline.savers import (
+    OSMSaver,
+    ParquetSaver,
+    UploadBuffer,
+    decode_quarantine_payload,
+    encode_quarantine_payload,
+)
+from osm.schemas import Component
+from osm.schemas.custom_fields import LongBytes
+
+
+def test_parquet_saver_flushes_partitioned_dataset(tmp_path):
+    saver = ParquetSaver(tmp_path / "metrics", buffer_size=2)
+    for i, year in enumerate([2020, 2021, 2020]):
+        saver.run(
+            {"year": year, "is_open_data": i % 2 == 0, "pmid": i},
+            user_defined_id=f"uid{i}",
+            content_hash=f"hash{i}",
+        )
+    # The first two rows were flushed when the buffer filled
+    assert len(list((tmp_path / "metrics").rglob("*.parquet"))) == 2
+    saver.close()
+
+    assert sorted(p.name for p in (tmp_path / "metrics").iterdir()) == [
+        "year=2020",
+        "year=2021",
+    ]
+    table = ds.dataset(
+        tmp_path / "metrics", format="parquet", partitioning="hive"
+    ).to_table()
+    assert table.num_rows == 3
+    assert sorted(table.column("user_defined_id").to_pylist()) == [
+        "uid0",
+        "uid1",
+        "uid2",
+    ]
+    assert (
+        table.schema.field("is_open_data").type
+        == saver.schema.field("is_open_data").type
+    )
+
+
+class FakeResponse:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.payload
+
+
+class FakeSession:
+    def __init__(self):
+        self.requests = []
+
+    def put(self, url, json=None, **kwargs):
+        self.requests.append((url, json))
+        if url.endswith("/upload/batch/"):
+            return FakeResponse(
+                {
+                    "inserted": len(json) - 1,
+                    "results": [
+                        {
+                            "index": i,
+                            "status": "inserted" if i else "invalid",
+                            "error": "bad",
+                        }
+                        for i in range(len(json))
+                    ],
+                }
+            )
+        return FakeResponse({})
+
+
+class UploadSession:
+    def __init__(self):
+        self.requests = []
+
+    def put(self, url, **kwargs):
+        self.requests.append((url, kwargs))
+        return SimpleNamespace(status_code=200, text="")
+
+
+def test_osm_saver_encodes_samples_into_the_body(monkeypatch):
+    monkeypatch.setenv("OSM_API", "http://api")
+    session = UploadSession()
+    saver = OSMSaver("comment", None, "uid", "paper.pdf", session=session)
+    parser = SimpleNamespace(
+        orm_model=Component(name="parser", version="0.0.1", sample=LongBytes(b"%PDF"))
+    )
+    saver.run(
+        b"%PDF",
+        metrics={"is_open_code": True, "is_open_data": False},
+        components=[parser],
+    )
+    [(url, kwargs)] = session.requests
+    assert url == "http://api/upload/"
+    assert "json" not in kwargs
+    assert kwargs["headers"]["Content-Type"] == "application/json"
+    body = json.loads(kwargs["data"])
+    assert "id" not in body
+    assert base64.b64decode(body["components"][0]["sample"]) == b"%PDF"
+
+
+def test_upload_buffer_uploads_in_batches(monkeypatch):
+    monkeypatch.setenv("OSM_API", "http://api")
+    session = FakeSession()
+    buffer = UploadBuffer(batch_size=2, max_wait=60, session=session)
+    for i in range(3):
+        buffer.add({"n": i})
+    assert [url for url, _ in session.requests] == [
+        "http://api/upload/batch/",
+        "http://api/quarantine/",
+    ]
+    buffer.close()
+
+    batches = [body for url, body in session.requests if url.endswith("batch/")]
+    assert batches == [[{"n": 0}, {"n": 1}], [{"n": 2}]]
+    assert buffer.uploaded == 1
+    assert buffer.rejected == 2
+
+
+def test_upload_buffer_keeps_batches_that_fail(monkeypatch):
+    monkeypatch.setenv("OSM_API", "http://api")
+    session = FakeSession()
+    put = session.put
+
+    def unavailable(url, json=None, **kwargs):
+        raise EnvironmentError("Cannot connect to OSM API")
+
+    session.put = unavailable
+    buffer = UploadBuffer(batch_size=2, max_wait=60, session=session)
+    for i in range(3):
+        buffer.add({"n": i})
+    assert buffer.uploaded == buffer.rejected == 0
+
+    session.put = put
+    buffer.close()
+    batches = [body for url, body in session.requests if url.endswith("batch/")]
+    assert batches == [[{"n": 0}, {"n": 1}], [{"n": 2}]]
+    assert buffer.uploaded + buffer.rejected == 3
+
+
+def test_upload_buffer_limits_batch_bytes(monkeypatch):
+    monkeypatch.setenv("OSM_API", "http://api")
+    session = FakeSession()
+    invocations = [{"n": i, "sample": "x" * 100} for i in range(3)]
+    size = len(json.dumps(invocations[0]))
+    buffer = UploadBuffer(
+        batch_size=10, max_wait=60, session=session, max_batch_bytes=2 * size
+    )
+    for invocation in invocations:
+        buffer.add(invocation)
+    buffer.close()
+    batches = [body for url, body in session.requests if url.endswith("batch/")]
+    assert batches == [invocations[:2], invocations[2:]]
+
+
+def test_quarantine_payload_stores_documents_once():
+    document = b"%PDF" + bytes(range(256)) * 100
+    payload = {
+        "work": {"filename": "paper.pdf"},
+        "metrics": {"funding_text": "x" * 100},
+        "components": [
+            Component(name="ScienceBeamParser", version="0.0.1", sample=document),
+            Component(name="RTransparentExtractor", version="0.0.1", sample=document),
+        ],
+    }
+    encoded = encode_quarantine_payload(payload, max_chars=10)
+    assert len(encoded) < len(document)
+
+    decoded = decode_quarantine_payload(encoded)
+    samples = [c["sample"] for c in decoded["payload"]["components"]]
+    assert samples[0] == samples[1]
+    assert decoded["blobs"] == {samples[0]["$blob"]: document}
+    assert decoded["payload"]["metrics"]["funding_text"].startswith("xxxxxxxxxx...")
+
+    without_blobs = decode_quarantine_payload(
+        encode_quarantine_payload(payload, max_blob_bytes=100)
+    )
+    assert without_blobs["blobs"] == {}
+    # Documents that are left out are still referenced with their size
+    [sample, _] = [c["sample"] for c in without_blobs["payload"]["components"]]
+    assert sample == samples[0]
+
+    # Memory mapped documents are encoded from the view
+    view = decode_quarantine_payload(
+        encode_quarantine_payload({"data": memoryview(document), "xml": b"<xml/>"})
+    )
+    assert view["blobs"] == {
+        view["payload"]["data"]["$blob"]: document,
+        view["payload"]["xml"]["$blob"]: b"<xml/>",
+    }
+
+
+def test_parquet_saver_rejects_rows_that_do_not_fit(tmp_path):
+    saver = ParquetSaver(tmp_path / "metrics", buffer_size=2)
+    saver.run({"year": 2020}, user_defined_id="uid0", content_hash="hash0")
+    with pytest.raises(pa.ArrowInvalid):
+        saver.run({"year": "unknown"}, user_defined_id="uid1", content_hash="hash1")
+    saver.close()
+    table = ds.dataset(tmp_path / "metrics", format="parquet").to_table()
+    assert table.column("user_defined_id").to_pylist() == ["uid0"]
@@ -1,5 +1,12 @@
+import datetime
+import json
+
 import pandas as pd
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pytest
 
 from osm.schemas import schema_helpers as osh
 
@@ -62,3 +69,189 @@ def test_transform_data():
 
 # Run the test
 test_transform_data()
+
+
+def per_row_payloads(table, **kwargs):
+    payloads = []
+    for row in table.to_pylist():
+        try:
+            payload = osh.get_invocation(row, **kwargs).model_dump(
+                mode="json", exclude="id"
+            )
+        except Exception:
+            continue
+        payloads.append(payload)
+    return payloads
+
+
+def without_timestamps(payloads):
+    # Serialized so that NaN values compare equal
+    return [
+        json.dumps({k: v for k, v in p.items() if k != "created_at"}, sort_keys=True)
+        for p in payloads
+    ]
+
+
+@pytest.mark.parametrize(
+    "custom_processing",
+    [None, "irp_data_processing", "rtransparent_pub_data_processing"],
+)
+def test_transform_data_matches_per_row_validation(custom_processing):
+    table = pa.table(
+        {
+            "is_open_code": [True, None, False, True, False],
+            "is_code_pred": [False, True, None, True, True],
+            "is_open_data": [False, True, None, True, False],
+            "is_data_pred": [True, True, False, None, True],
+            # Floats are accepted as integers when they have no fractional part
+            "pmid": [1.0, None, 2.5, float("nan"), 5.0],
+            # pydantic coerces these strings to integers
+            "year": ["2020", None, "2021", "x", None],
+            "score": [0.5, float("nan"), None, 1, 2],
+            "open_data_statements": ["", "statement", None, "a", "b"],
+            "filename": ["a.xml", None, "", "d.xml", "e.xml"],
+            "funder": ["NIH", None, "Wellcome", None, "ERC"],
+            "unrelated": [1, 2, 3, 4, 5],
+        }
+    )
+    kwargs = {
+        "data_tags": ["tag"],
+        "components": [{"name": "RTransparent", "version": "x.x.x"}],
+        "custom_processing": custom_processing,
+    }
+    expected = per_row_payloads(table, **kwargs)
+    start = datetime.datetime.now(datetime.UTC)
+    result = list(osh.transform_data(table, raise_error=False, batch_size=2, **kwargs))
+    assert without_timestamps(result) == without_timestamps(expected)
+    # Each payload is timestamped when its row is converted
+    created_at = [datetime.datetime.fromisoformat(p["created_at"]) for p in result]
+    assert start <= created_at[0]
+    assert created_at == sorted(created_at)
+    assert created_at[-1] <= datetime.datetime.now(datetime.UTC)
+
+
+class FakeCollection:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def aggregate(self, aggregation, batchSize=None):
+        return iter(self.documents)
+
+
+def test_export_invocations_streams_to_parquet(tmp_path):
+    documents = [
+        {
+            "_id": i,
+            "funder": ["NIH"] if i % 2 else None,
+            "data_tags": ["tag"],
+            "work": {"pmid": i},
+            "metrics": {
+                "year": 2000 + i,
+                "is_open_data": bool(i % 2),
+                "is_open_code": None,
+                "journal": "Journal",
+            },
+            # Bulk uploads store created_at as a string
+            "created_at": "2024-01-01T00:00:00Z"
+            if i % 2
+            else datetime.datetime(2024, 1, 2),
+        }
+        for i in range(5)
+    ]
+    path = tmp_path / "invocations.parquet"
+    rows = osh.export_invocations(
+        path, batch_size=2, collection=FakeCollection(documents)
+    )
+    assert rows == 5
+
+    table = pq.read_table(path)
+    assert table.schema == osh.get_export_schema(osh.DASHBOARD_AGGREGATION)
+    assert table["pmid"].to_pylist() == list(range(5))
+    assert table["affiliation_country"].null_count == 5
+    assert table["created_at"][1].as_py() == datetime.datetime(
+        2024, 1, 1, tzinfo=datetime.UTC
+    )
+
+
+def test_record_batch_nulls_values_that_do_not_fit(caplog):
+    schema = pa.schema(
+        [
+            pa.field("year", pa.int64()),
+            pa.field("funder", pa.list_(pa.string())),
+        ]
+    )
+    rows = [
+        {"year": 2020.0, "funder": "NIH"},
+        {"year": 2020.7, "funder": ["ERC", "Wellcome"]},
+        {"year": "unknown", "funder": None},
+    ]
+    batch = osh._to_record_batch(rows, schema)
+    assert batch["year"].to_pylist() == [2020, None, None]
+    assert batch["funder"].to_pylist() == [["NIH"], ["ERC", "Wellcome"], None]
+    assert "year=2020.7" in caplog.text
+
+
+class WatermarkCollection(FakeCollection):
+    def aggregate(self, aggregation, batchSize=None):
+        match = aggregation[0]["$match"]
+        if "inserted_at" not in match:
+            return iter(self.documents)
+        since = match["inserted_at"]["$gte"]
+        return iter(
+            doc
+            for doc in self.documents
+            if doc.get("inserted_at") is not None and doc["inserted_at"] >= since
+        )
+
+
+def test_update_snapshot_appends_new_invocations(tmp_path):
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.UTC)
+
+    def document(i, created_at, inserted_at):
+        return {
+            "_id": f"id{i}",
+            "data_tags": ["tag"],
+            "work": {"pmid": i},
+            "metrics": {"year": 2020},
+            "created_at": created_at,
+            "inserted_at": inserted_at,
+        }
+
+    documents = [
+        document(
+            i, start + datetime.timedelta(days=i), start + datetime.timedelta(days=i)
+        )
+        for i in range(3)
+    ]
+    # Stored before inserted_at was recorded
+    documents.append(document(3, "2023-06-01T00:00:00Z", None))
+    collection = WatermarkCollection(documents)
+    snapshot = tmp_path / "snapshot"
+    assert osh.update_snapshot(snapshot, collection=collection) == 4
+    assert osh.update_snapshot(snapshot, collection=collection) == 0
+
+    # Created long before the watermark, e.g. queued in an outbox, but stored
+    # after it, and a bulk upload with created_at as a string
+    documents.append(document(4, start, start + datetime.timedelta(days=3)))
+    documents.append(
+        document(5, "2023-01-01T00:00:00Z", start + datetime.timedelta(days=4))
+    )
+    assert osh.update_snapshot(snapshot, collection=collection) == 2
+    assert len(list(snapshot.glob("part-*.parquet"))) == 2
+
+    documents.append(document(6, start, start + datetime.timedelta(days=5)))
+    assert osh.update_snapshot(snapshot, collection=collection, compact_after=2) == 1
+    assert len(list(snapshot.glob("part-*.parquet"))) == 1
+    table = ds.dataset(snapshot, format="parquet").to_table()
+    assert sorted(table["pmid"].to_pylist()) == list(range(7))
+
+    # Replaced on upload, so stored again under the same id
+    replacement = document(6, start, start + datetime.timedelta(days=6))
+    replacement["metrics"]["year"] = 2021
+    documents[-1] = replacement
+    assert osh.update_snapshot(snapshot, collection=collection) == 1
+    assert len(list(snapshot.glob("part-*.parquet"))) == 1
+    table = ds.dataset(snapshot, format="parquet").to_table()
+    assert sorted(table["pmid"].to_pylist()) == list(range(7))
+    [year] = table.filter(pc.equal(table["pmid"], 6))["year"].to_pylist()
+    assert year == 2021
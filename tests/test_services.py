@@ -0,0 +1,34 @@
+import os
+
+from osm import _services
+from osm._services import ServiceLease, _get_lease_dir, active_leases
+
+
+def test_leases_track_live_processes(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    lease_dir = _get_lease_dir()
+    # A process id that cannot be running
+    (lease_dir / f"{2**22 + 1}.lease").touch()
+
+    lease = ServiceLease()
+    lease.acquire()
+    assert active_leases(lease_dir) == [os.getpid()]
+    assert not (lease_dir / f"{2**22 + 1}.lease").exists()
+
+    lease.release()
+    assert active_leases(lease_dir) == []
+    assert (lease_dir / "last_used").exists()
+
+
+def test_services_are_not_stopped_while_leased(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    stopped = []
+    monkeypatch.setattr(_services, "compose_down", lambda: stopped.append(True))
+    lease = ServiceLease()
+    lease.acquire()
+    _services.stop_services()
+    assert stopped == []
+
+    lease.release()
+    _services.stop_services()
+    assert stopped == [True]
@@ -2,13 +2,16 @@
 Sets up a web API for uploading osm metrics to a centralized database
 """
 
+import datetime
 import os
+from typing import Any, Literal, Optional
 
 import motor.motor_asyncio
 from fastapi import FastAPI, File, Form, HTTPException, UploadFile, status
 from fastapi.responses import JSONResponse
 from odmantic import AIOEngine, ObjectId
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
+from pymongo.errors import BulkWriteError
 
 from osm.schemas import Invocation, PayloadError, Quarantine
 
@@ -47,10 +50,72 @@ def get_health() -> HealthCheck:
 
 @app.put("/upload/", response_model=Invocation)
 async def upload_invocation(invocation: Invocation):
+    invocation.inserted_at = datetime.datetime.now(datetime.UTC)
     await engine.save(invocation)
     return invocation
 
 
+DUPLICATE_KEY_ERROR = 11000
+
+
+class UploadResult(BaseModel):
+    """Outcome of uploading one invocation of a batch."""
+
+    index: int
+    status: Literal["inserted", "duplicate", "invalid", "failed"]
+    id: Optional[str] = None
+    error: Optional[str] = None
+
+
+class BatchUploadResponse(BaseModel):
+    inserted: int
+    results: list[UploadResult]
+
+
+@app.put("/upload/batch/", response_model=BatchUploadResponse)
+async def upload_invocations(payloads: list[dict[str, Any]]):
+    """
+    Validate and store many invocations with a single write. Every payload is
+    inserted independently so invalid or rejected payloads do not affect the
+    rest of the batch. The response holds one result per payload, in order.
+    Payloads may carry their own id so that retried uploads are reported as
+    duplicates rather than stored twice.
+    """
+    results = [UploadResult(index=i, status="inserted") for i in range(len(payloads))]
+    valid = []
+    for i, payload in enumerate(payloads):
+        try:
+            invocation = Invocation.model_validate(payload)
+        except ValidationError as e:
+            results[i].status = "invalid"
+            results[i].error = str(e)
+            continue
+        results[i].id = str(invocation.id)
+        valid.append((i, invocation))
+    inserted_at = datetime.datetime.now(datetime.UTC)
+    for _, invocation in valid:
+        invocation.inserted_at = inserted_at
+    if valid:
+        collection = engine.get_collection(Invocation)
+        try:
+            await collection.insert_many(
+                [invocation.model_dump_doc() for _, invocation in valid],
+                ordered=False,
+            )
+        except BulkWriteError as e:
+            for write_error in e.details["writeErrors"]:
+                result = results[valid[write_error["index"]][0]]
+                if write_error["code"] == DUPLICATE_KEY_ERROR:
+                    result.status = "duplicate"
+                else:
+                    result.status = "failed"
+                    result.error = write_error["errmsg"]
+    return BatchUploadResponse(
+        inserted=sum(result.status == "inserted" for result in results),
+        results=results,
+    )
+
+
 @app.put("/payload_error/", response_model=PayloadError)
 async def upload_failed_payload_construction(payload_error: PayloadError):
     await engine.save(payload_error)
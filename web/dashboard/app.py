@@ -5,7 +5,6 @@ import panel as pn
 import param
 import pyarrow as pa
 import pyarrow.dataset as ds
-import pyarrow.parquet as pq
 import ui
 from main_dashboard import MainDashboard
 from pyarrow import compute as pc
@@ -14,12 +13,15 @@ from osm.schemas import schema_helpers as osh
 
 
 def load_data():
-    local_path = os.environ.get("LOCAL_DATA_PATH")
-    if local_path is not None and Path(local_path).exists():
-        dset = ds.dataset(local_path, format="parquet")
-    else:
-        dset = ds.dataset(osh.matches_to_table(osh.get_data_from_mongo()))
-        pq.write_table(dset.to_table(), local_path, compression="snappy")
+    local_path = os.environ.get("LOCAL_DATA_PATH", "dashboard_data.parquet")
+    if snapshot_dir := os.environ.get("DASHBOARD_SNAPSHOT_DIR"):
+        # Only the invocations created since the last refresh are fetched
+        osh.update_snapshot(snapshot_dir)
+        local_path = snapshot_dir
+    elif not Path(local_path).exists():
+        # Stream the invocations to disk rather than building the table in memory
+        osh.export_invocations(local_path)
+    dset = ds.dataset(local_path, format="parquet")
 
     tb = dset.to_table()
     split_col = pc.split_pattern(